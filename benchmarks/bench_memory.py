@@ -0,0 +1,118 @@
+# Memory used by scan results: per-file dicts with hex digests (the original representation)
+# against the columnar FileTable/DuplicateIndex, for synthetic scans of N files.
+#
+#   python benchmarks/bench_memory.py --counts 1000000 5000000
+import argparse
+import gc
+import hashlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dedup import DuplicateIndex, FileTable
+
+class FakeStat:
+    __slots__ = ('st_size', 'st_ctime', 'st_mtime_ns', 'st_ino', 'st_dev', 'st_nlink')
+
+    def __init__(self, size, ctime, ino):
+        self.st_size = size
+        self.st_ctime = ctime
+        self.st_mtime_ns = int(ctime * 1e9)
+        self.st_ino = ino
+        self.st_dev = 2049
+        self.st_nlink = 1
+
+def synthetic_files(count, files_per_dir, duplicate_every):
+    # Every duplicate_every-th file repeats the content of the file before it
+    for i in range(count):
+        content_id = i - 1 if duplicate_every and i % duplicate_every == 0 and i else i
+        directory = f"/srv/archive/photos/{i // (files_per_dir * 50):05d}/{i // files_per_dir:07d}"
+        yield (directory, f"IMG_{i:08d}.JPG", content_id, FakeStat(1_000_000 + content_id, 1.7e9 + i, i))
+
+def digest_of(content_id):
+    return hashlib.md5(content_id.to_bytes(8, 'little')).digest()
+
+def build_dicts(count, files_per_dir, duplicate_every):
+    files = []
+    hash_map = {}
+    for directory, name, content_id, st in synthetic_files(count, files_per_dir, duplicate_every):
+        file_info = {
+            'path': os.path.join(directory, name),
+            'name': name,
+            'size': st.st_size,
+            'ctime': st.st_ctime,
+            'hash': digest_of(content_id).hex()
+        }
+        files.append(file_info)
+        hash_map.setdefault(file_info['hash'], []).append(file_info)
+    matches = []
+    for group in hash_map.values():
+        for duplicate in group[1:]:
+            matches.append({
+                'file1': group[0]['path'],
+                'file2': duplicate['path'],
+                'is_image': group[0]['path'].lower().endswith(('.jpg', '.png')),
+                'name1': group[0]['name'],
+                'name2': duplicate['name']
+            })
+    return files, hash_map, matches
+
+def build_columns(count, files_per_dir, duplicate_every):
+    table = FileTable()
+    content_groups = {}
+    for directory, name, content_id, st in synthetic_files(count, files_per_dir, duplicate_every):
+        file_id = table.add(directory, name, st)
+        table.set_digest(file_id, digest_of(content_id))
+        content_groups.setdefault(content_id, []).append(file_id)
+    duplicates = DuplicateIndex(table, 'md5')
+    for file_ids in content_groups.values():
+        if len(file_ids) > 1:
+            duplicates.add_group(file_ids, table.digest(file_ids[0]))
+    return table, duplicates
+
+def measure(builder, *args):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = builder(*args)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    gc.collect()
+    return {'retained_bytes': current, 'peak_bytes': peak, 'build_seconds': round(elapsed, 2)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the memory used by dict and columnar scan results.")
+    parser.add_argument('--counts', type=int, nargs='+', default=[1_000_000, 5_000_000])
+    parser.add_argument('--files-per-dir', type=int, default=200)
+    parser.add_argument('--duplicate-every', type=int, default=10)
+    parser.add_argument('--skip-dicts', action='store_true', help="Only measure the columnar layout")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for count in args.counts:
+        row = {'files': count}
+        params = (count, args.files_per_dir, args.duplicate_every)
+        if not args.skip_dicts:
+            row['dicts'] = measure(build_dicts, *params)
+        row['columns'] = measure(build_columns, *params)
+        results.append(row)
+
+        line = f"{count:>10,} files: columns {row['columns']['retained_bytes'] / 2**20:8.1f} MB"
+        if 'dicts' in row:
+            ratio = row['dicts']['retained_bytes'] / row['columns']['retained_bytes']
+            line += f", dicts {row['dicts']['retained_bytes'] / 2**20:8.1f} MB ({ratio:.1f}x)"
+        print(line, flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+# Times the scan pipeline stage by stage on a generated tree: walk (listing only), stat, group by
+# size, hash (the staged hasher on the size groups), match (duplicate groups and review pairs),
+# then the whole of DuplicateFinder.compare_single_directory end to end. Trees are generated
+# from a seed, so two commits benchmarked with the same arguments see the same files.
+# Files are read from the page cache after the first stage that touches them.
+#
+#   python benchmarks/bench_pipeline.py --files 50000 --duplicate-ratio 0.2 --output before.json
+#   python benchmarks/bench_pipeline.py --root /mnt/disk/tree --keep-tree ...
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dedup import HASH_ALGORITHMS, DuplicateFinder, DuplicateIndex, FileTable, HashExecutor, StagedHasher
+from dedup.scanner import scan_directory
+
+SIZE_DISTRIBUTIONS = ('lognormal', 'uniform', 'fixed')
+
+def file_size(rng, args):
+    if args.size_distribution == 'fixed':
+        return args.mean_size
+    if args.size_distribution == 'uniform':
+        return rng.randint(args.min_size, 2 * args.mean_size - args.min_size)
+    # Most files small, a long tail of large ones, like a home directory
+    sigma = 1.5
+    size = int(rng.lognormvariate(math.log(args.mean_size) - sigma * sigma / 2, sigma))
+    return max(args.min_size, min(size, args.max_size))
+
+def directory_for(rng, root, depth, fanout):
+    parts = [f"d{rng.randrange(fanout)}" for _ in range(rng.randint(1, depth))]
+    return os.path.join(root, *parts)
+
+def generate_tree(root, args):
+    # Unique files, copies of earlier files, files sharing a size with an earlier file but not
+    # its content (the case the partial hash stages are for) and hard links of earlier files
+    rng = random.Random(args.seed)
+    written = []
+    counts = {'unique': 0, 'duplicate': 0, 'same_size': 0, 'hardlink': 0, 'bytes': 0}
+    for i in range(args.files):
+        directory = directory_for(rng, root, args.depth, args.fanout)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"file_{i:08d}.bin")
+        roll = rng.random()
+        if written and roll < args.hardlink_ratio:
+            os.link(rng.choice(written)[0], path)
+            counts['hardlink'] += 1
+            continue
+        if written and roll < args.hardlink_ratio + args.duplicate_ratio:
+            source, size = rng.choice(written)
+            shutil.copyfile(source, path)
+            kind = 'duplicate'
+        else:
+            if written and roll < args.hardlink_ratio + args.duplicate_ratio + args.same_size_ratio:
+                size = rng.choice(written)[1]
+                kind = 'same_size'
+            else:
+                size = file_size(rng, args)
+                kind = 'unique'
+            with open(path, 'wb') as f:
+                f.write(rng.randbytes(size))
+        written.append((path, size))
+        counts[kind] += 1
+        counts['bytes'] += size
+    return counts
+
+def peak_rss():
+    # Peak resident set size of this process so far, in bytes
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def timed(results, stage, func, files=0, bytes_read=0):
+    start = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start
+    if callable(files):
+        files = files(value)
+    if callable(bytes_read):
+        bytes_read = bytes_read(value)
+    results[stage] = {
+        'seconds': round(elapsed, 4),
+        'files': files,
+        'files_per_second': round(files / elapsed, 1) if elapsed else None,
+        'bytes_read': bytes_read,
+        'mb_per_second': round(bytes_read / elapsed / 2**20, 1) if elapsed else None,
+        'peak_rss_bytes': peak_rss(),
+    }
+    return value
+
+def list_paths(root):
+    # The walk without any stat call beyond what os.scandir does to tell files from folders
+    paths = []
+    pending = [root]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    paths.append(entry.path)
+    return paths
+
+def run_stages(root, args):
+    results = {}
+    paths = timed(results, 'walk', lambda: list_paths(root), files=len)
+    timed(results, 'stat', lambda: [os.stat(path) for path in paths], files=len)
+
+    def build_table():
+        table = FileTable()
+        for dirpath, name, st in scan_directory(root, log=lambda message: None):
+            table.add(dirpath, name, st)
+        return table
+
+    table = timed(results, 'scan', build_table, files=len)
+
+    def group_by_size():
+        # One name per inode, the way the finder groups files
+        seen = set()
+        sizes = {}
+        for file_id in range(len(table)):
+            key = (table.devices[file_id], table.inodes[file_id])
+            if key in seen:
+                continue
+            seen.add(key)
+            sizes.setdefault(table.sizes[file_id], []).append(file_id)
+        return [group for group in sizes.values() if len(group) > 1]
+
+    size_groups = timed(results, 'group', group_by_size, files=lambda groups: sum(map(len, groups)))
+
+    def hash_groups():
+        with HashExecutor(args.workers, args.backend) as executor:
+            hasher = StagedHasher(table, executor, algorithm=args.algorithm)
+            groups = hasher.find_duplicates(size_groups)
+        return groups, hasher
+
+    groups, hasher = timed(results, 'hash', hash_groups,
+                           files=lambda value: sum(stats['files'] for stats in value[1].stats.values()),
+                           bytes_read=lambda value: sum(stats['bytes'] for stats in value[1].stats.values()))
+    results['hash']['stages'] = hasher.stats
+
+    def match():
+        duplicates = DuplicateIndex(table, args.algorithm)
+        for group in groups:
+            duplicates.add_group(group, table.digest(group[0]))
+        return duplicates, list(duplicates.pairs())
+
+    duplicates, pairs = timed(results, 'match', match, files=lambda value: len(value[1]))
+    results['match']['groups'] = len(duplicates)
+    results['match']['reclaimable_bytes'] = duplicates.reclaimable_bytes()
+
+    def end_to_end():
+        finder = DuplicateFinder(workers=args.workers, backend=args.backend, algorithm=args.algorithm,
+                                 log=lambda message: None)
+        return finder, finder.compare_single_directory(root)
+
+    # Bytes read are summed from the finder's telemetry, where every hash stage counts its reads
+    finder, _ = timed(results, 'end_to_end', end_to_end, files=lambda value: len(value[0].table),
+                      bytes_read=lambda value: sum(timer.bytes for timer in value[0].telemetry.stages.values()))
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the scan, hash and match stages on a synthetic tree.")
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--size-distribution', choices=SIZE_DISTRIBUTIONS, default='lognormal')
+    parser.add_argument('--mean-size', type=int, default=64 * 1024, help="Mean file size in bytes")
+    parser.add_argument('--min-size', type=int, default=0)
+    parser.add_argument('--max-size', type=int, default=64 * 2**20)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2, help="Share of files copying an earlier file")
+    parser.add_argument('--same-size-ratio', type=float, default=0.05,
+                        help="Share of files with the size but not the content of an earlier file")
+    parser.add_argument('--hardlink-ratio', type=float, default=0.02, help="Share of files hard linking an earlier file")
+    parser.add_argument('--depth', type=int, default=4, help="Maximum folder nesting")
+    parser.add_argument('--fanout', type=int, default=8, help="Subfolders per folder")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--backend', choices=HashExecutor.BACKENDS, default='thread')
+    parser.add_argument('--algorithm', choices=list(HASH_ALGORITHMS), default='md5')
+    parser.add_argument('--root', help="Generate the tree here instead of in a temporary directory; "
+                                       "an existing non-empty folder is benchmarked as it is")
+    parser.add_argument('--keep-tree', action='store_true',
+                        help="Do not delete a generated tree afterwards; an existing --root is always kept")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix='dedup_bench_')
+    # Only a tree this script generated is deleted afterwards, never an existing folder
+    generated = False
+    dataset = None
+    try:
+        if not os.path.isdir(root) or not os.listdir(root):
+            generated = True
+            start = time.perf_counter()
+            dataset = generate_tree(root, args)
+            dataset['seconds'] = round(time.perf_counter() - start, 2)
+            print(f"Generated {args.files} files, {dataset['bytes'] / 2**20:.1f} MB in {dataset['seconds']} s: "
+                  f"{dataset['duplicate']} duplicates, {dataset['same_size']} same size, "
+                  f"{dataset['hardlink']} hard links", flush=True)
+        stages = run_stages(root, args)
+    finally:
+        if generated and not args.keep_tree:
+            shutil.rmtree(root, ignore_errors=True)
+
+    for stage, row in stages.items():
+        line = f"{stage:>10}: {row['seconds']:8.3f} s"
+        if row['files_per_second']:
+            line += f", {row['files_per_second']:10.1f} files/s"
+        if row['bytes_read']:
+            line += f", {row['mb_per_second']:8.1f} MB/s, {row['bytes_read'] / 2**20:.1f} MB read"
+        print(line)
+
+    if args.output:
+        options = {key: value for key, value in vars(args).items() if key not in ('output', 'keep_tree')}
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': options,
+                'dataset': dataset,
+                'stages': stages,
+            }, f, indent=2)
+
+if __name__ == '__main__':
+    main()
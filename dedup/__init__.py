@@ -0,0 +1,23 @@
+# Scanning and matching engine, importable without tkinter, PIL or pandas
+from .utils import format_size, get_config_dir
+from .hashing import (
+    HASH_ALGORITHMS, DEFAULT_ALGORITHM, MMAP_THRESHOLD, HashExecutor, StagedHasher,
+    get_file_hash, hash_file, hash_ranges,
+)
+from .cache import HashCache
+from .actions import (
+    ACTIONS, QUARANTINE_DIR, AlreadyLinked, apply_action, replace_file, create_journal, resume_action, rollback_action,
+)
+from .journal import ActionJournal, unfinished_journals
+from .manifest import ScanManifest
+from .engine import DuplicateFinder
+from .groups import KEEP_POLICIES, DuplicateGroup, DuplicateIndex
+from .scanner import SYMLINK_POLICIES, WalkOptions, scan_directory, scan_incremental
+from .telemetry import ScanTelemetry, json_lines_sink
+from .progress import ProgressTracker, ScanCancelled, format_progress
+from .records import FileTable, stat_key
+from .results import ResultsError, load_results, results_header, save_results
+from .review import SORT_KEYS, GroupTable
+from .similar import (
+    PERCEPTUAL_HASHES, DEFAULT_PERCEPTUAL_HASH, DEFAULT_THRESHOLD, IMAGE_EXTENSIONS, HammingIndex, image_hash,
+)
@@ -0,0 +1,267 @@
+import errno
+import os
+import shutil
+import uuid
+
+from .hashing import HashExecutor
+from .journal import ActionJournal, new_run_id
+from .records import stat_key
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl number of FICLONE (_IOW(0x94, 9, int)), shares all extents of one file with another on
+# btrfs, XFS and other copy-on-write filesystems
+FICLONE = 0x40049409
+
+# What can be done with a duplicate once a kept copy is chosen. Links keep every path valid,
+# quarantine moves the file into a folder it can be restored from.
+ACTIONS = ('delete', 'quarantine', 'hardlink', 'reflink')
+
+# Files handed to one worker task at a time
+ACTION_BATCH_SIZE = 64
+
+# Name of quarantine folders; scans never descend into them
+QUARANTINE_DIR = '.dedup-quarantine'
+
+class AlreadyLinked(Exception):
+    # The duplicate and its kept copy are the same inode, there is nothing to reclaim
+    pass
+
+def temp_path(filepath):
+    # Hidden name next to the file, so os.replace stays on the same filesystem
+    directory, name = os.path.split(filepath)
+    return os.path.join(directory, f".{name}.{uuid.uuid4().hex[:12]}.dedup-tmp")
+
+def quarantine_path(quarantine, filepath):
+    # Where filepath goes in the quarantine folder: its whole absolute path below it, so files of
+    # the same name never collide and the original location stays readable
+    drive, rest = os.path.splitdrive(os.path.abspath(filepath))
+    parts = [drive.replace(':', '').strip('\\/')] if drive else []
+    return os.path.join(quarantine, *parts, rest.lstrip('\\/'))
+
+def move_to_quarantine(filepath, destination):
+    # A rename within one filesystem only moves the directory entry, the data is never copied
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if os.path.lexists(destination):
+        raise FileExistsError(errno.EEXIST, "Already in quarantine", destination)
+    try:
+        os.rename(filepath, destination)
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            raise OSError(errno.EXDEV, "Quarantine folder is on another filesystem", filepath) from e
+        raise
+
+def reflink(source, destination):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    with open(source, 'rb') as src, open(destination, 'xb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+def replace_file(action, filepath, keep_path, expected_key=None, quarantine=None):
+    # Deletes filepath, moves it into the quarantine folder, or atomically swaps it for a
+    # hardlink or reflink of keep_path: the link is made under a temporary name first and then
+    # moved over filepath with os.replace.
+    # expected_key is the stat key seen by the scan, fields that are None are not compared;
+    # a file that changed since is left alone.
+    st = os.stat(filepath)
+    if expected_key is not None and any(expected is not None and expected != actual
+                                        for expected, actual in zip(expected_key, stat_key(st))):
+        raise OSError(errno.ESTALE, "File changed since it was scanned", filepath)
+    if action in ('delete', 'quarantine'):
+        # Removing a file is only safe while another file with its content stays: the kept copy
+        # must exist and must not be filepath itself under another name or through a symlink
+        try:
+            keep_st = os.stat(keep_path)
+        except FileNotFoundError:
+            raise OSError(errno.ENOENT, "Kept copy is missing", keep_path) from None
+        if os.path.samestat(st, keep_st):
+            raise OSError(errno.EINVAL, "Kept copy is the same file", keep_path)
+    if action == 'delete':
+        os.remove(filepath)
+        return st.st_size
+    if action == 'quarantine':
+        if quarantine is None:
+            raise ValueError("No quarantine folder given")
+        move_to_quarantine(filepath, quarantine_path(quarantine, filepath))
+        return st.st_size
+
+    keep_st = os.stat(keep_path)
+    if (st.st_dev, st.st_ino) == (keep_st.st_dev, keep_st.st_ino):
+        raise AlreadyLinked(filepath)
+    if st.st_size != keep_st.st_size:
+        raise OSError(errno.EINVAL, "Kept copy has a different size", keep_path)
+
+    tmp = temp_path(filepath)
+    try:
+        if action == 'hardlink':
+            os.link(keep_path, tmp)
+        elif action == 'reflink':
+            reflink(keep_path, tmp)
+            # The clone is a new inode, give it the metadata of the file it replaces
+            shutil.copystat(filepath, tmp)
+        else:
+            raise ValueError(f"Unknown action: {action}")
+        os.replace(tmp, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return st.st_size
+
+def already_done(action, filepath, quarantine):
+    # A resumed run meets files whose job finished just before the previous run stopped, but
+    # whose outcome never reached the journal
+    if action == 'delete':
+        return not os.path.lexists(filepath)
+    if action == 'quarantine':
+        return not os.path.lexists(filepath) and os.path.lexists(quarantine_path(quarantine, filepath))
+    return False
+
+def run_batch(action, jobs, quarantine=None, cancel=None, resuming=False):
+    # Worker entry point, one (bytes freed, error message) per (path, keep path, stat key) job,
+    # or None for jobs skipped once cancel is set.
+    results = []
+    for filepath, keep_path, expected_key in jobs:
+        if cancel is not None and cancel.is_set():
+            results.append(None)
+            continue
+        try:
+            results.append((replace_file(action, filepath, keep_path, expected_key, quarantine), None))
+        except AlreadyLinked:
+            results.append((0, None))
+        except FileNotFoundError as e:
+            if resuming and already_done(action, filepath, quarantine):
+                results.append((0, None))
+            else:
+                results.append((0, f"{filepath}: {str(e)}"))
+        except (OSError, ValueError) as e:
+            results.append((0, f"{filepath}: {str(e)}"))
+    return results
+
+def directory_batches(paths, indices=None, batch_size=ACTION_BATCH_SIZE):
+    # Job indices in batches of files from as few folders as possible. Removing or renaming a
+    # file locks its folder, so workers on different folders do not wait on each other, and a
+    # worker keeps finding the folder it works on cached.
+    by_directory = {}
+    for index in (range(len(paths)) if indices is None else indices):
+        by_directory.setdefault(os.path.dirname(paths[index]), []).append(index)
+    batches = []
+    batch = []
+    for directory in sorted(by_directory):
+        for index in by_directory[directory]:
+            batch.append(index)
+            if len(batch) == batch_size:
+                batches.append(batch)
+                batch = []
+    if batch:
+        batches.append(batch)
+    return batches
+
+def run_batches(batch_func, batches, workers, progress=None, journal=None):
+    # Runs batch_func(batch of job indices) on a thread pool and yields (indices, results) per
+    # batch as it completes, after recording it in the journal
+    total = sum(map(len, batches))
+    done = 0
+    with HashExecutor(workers, 'thread') as executor:
+        for index, batch_results, error in executor.map(batch_func, [(batch,) for batch in batches]):
+            indices = batches[index]
+            if error is not None:
+                batch_results = [(0, str(error))] * len(indices)
+            if journal is not None:
+                journal.record(indices, batch_results)
+            done += len(indices)
+            if progress:
+                progress(done, total)
+            yield indices, batch_results
+
+def apply_action(action, jobs, workers=None, progress=None, quarantine=None, journal=None, cancel=None,
+                 resuming=False, indices=None):
+    # Runs the action over (path, keep path, stat key) jobs in per-folder batches on a thread pool
+    # and returns one (bytes freed, error message or None) per job, in job order; jobs not run,
+    # because cancel was set or they are not in indices, get None.
+    # Every outcome is recorded in journal, if given, as its batch completes.
+    # progress(done, total) is called after every batch.
+    if action not in ACTIONS:
+        raise ValueError(f"Unknown action: {action}")
+    if action == 'quarantine' and quarantine is None:
+        raise ValueError("No quarantine folder given")
+
+    def batch_func(batch):
+        return run_batch(action, [jobs[i] for i in batch], quarantine, cancel, resuming)
+
+    results = [None] * len(jobs)
+    batches = directory_batches([job[0] for job in jobs], indices)
+    for batch, batch_results in run_batches(batch_func, batches, workers, progress, journal):
+        for index, result in zip(batch, batch_results):
+            results[index] = result
+    if journal is not None:
+        journal.finish()
+    return results
+
+def create_journal(action, jobs, quarantine_root=None, path=None):
+    # Journal of a new run; a quarantine run moves its files into a folder of its own below
+    # quarantine_root, so every run can be rolled back by itself
+    run_id = new_run_id()
+    quarantine = os.path.join(os.path.abspath(quarantine_root), run_id) if quarantine_root is not None else None
+    return ActionJournal.create(action, jobs, quarantine, path, run_id)
+
+def resume_action(path, workers=None, progress=None, cancel=None):
+    # Runs the jobs of a journal that have not succeeded yet; returns the (closed) journal and
+    # results like apply_action's, with None for the jobs that were already done
+    with ActionJournal.open(path) as journal:
+        return journal, apply_action(journal.action, journal.jobs, workers, progress, journal.quarantine, journal,
+                                     cancel, resuming=True, indices=journal.pending())
+
+def restore_batch(jobs, quarantine):
+    # Moves quarantined files back, never over a file that took their place since
+    results = []
+    for filepath, keep_path, expected_key in jobs:
+        source = quarantine_path(quarantine, filepath)
+        try:
+            if os.path.lexists(filepath):
+                raise FileExistsError(errno.EEXIST, "A file of that name exists again", filepath)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            os.rename(source, filepath)
+            remove_empty_dirs(os.path.dirname(source), quarantine)
+            results.append((0, None))
+        except OSError as e:
+            results.append((0, f"{filepath}: {str(e)}"))
+    return results
+
+def remove_empty_dirs(directory, top):
+    # Removes directory and its parents up to and including top while they are empty
+    top = os.path.abspath(top)
+    directory = os.path.abspath(directory)
+    while directory == top or directory.startswith(top + os.sep):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+def rollback_action(path, workers=None, progress=None):
+    # Moves the files a quarantine run moved aside back where they were. Deleted files are gone
+    # and linked ones already share their data, so only quarantine runs can be rolled back.
+    # Returns the (closed) journal and results like apply_action's.
+    with ActionJournal.open(path) as journal:
+        if journal.action != 'quarantine':
+            raise ValueError(f"Only quarantine runs can be rolled back, this one used {journal.action}")
+        jobs = journal.jobs
+        restorable = [index for index in journal.done() if index not in journal.restored]
+        results = [None] * len(jobs)
+        batches = directory_batches([job[0] for job in jobs], restorable)
+
+        def batch_func(batch):
+            return restore_batch([jobs[i] for i in batch], journal.quarantine)
+
+        for batch, batch_results in run_batches(batch_func, batches, workers, progress):
+            journal.record_restored([index for index, (freed, error) in zip(batch, batch_results) if error is None])
+            for index, result in zip(batch, batch_results):
+                results[index] = result
+        journal.end(rolled_back=True)
+        return journal, results
@@ -0,0 +1,117 @@
+import os
+import sqlite3
+import threading
+
+from .hashing import DEFAULT_ALGORITHM
+from .utils import get_config_dir
+
+class HashCache:
+    # Full-content digests per algorithm, reused while a file's size, mtime and inode are unchanged.
+    # Entries are looked up with a stat key, (size, mtime_ns, inode, device), see records.stat_key.
+    SCHEMA_VERSION = 2
+
+    def __init__(self, db_path=None, algorithm=DEFAULT_ALGORITHM, commit_every=1000):
+        if db_path is None:
+            db_path = os.path.join(get_config_dir(), 'hash_cache.sqlite3')
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.algorithm = algorithm
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        self.pending_writes = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            # Older caches stored hex digests without their algorithm, start over
+            self.conn.execute("DROP TABLE IF EXISTS hashes")
+            self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "path TEXT, algorithm TEXT, size INTEGER, mtime_ns INTEGER, "
+            "inode INTEGER, device INTEGER, digest BLOB, PRIMARY KEY (path, algorithm))"
+        )
+        self.conn.commit()
+
+    def get(self, filepath, key, algorithm=None):
+        # algorithm overrides the cache's own, e.g. for perceptual hashes stored next to digests
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size, mtime_ns, inode, device, digest FROM hashes WHERE path = ? AND algorithm = ?",
+                (filepath, algorithm or self.algorithm)
+            ).fetchone()
+            if row and row[:4] == key:
+                self.hits += 1
+                return row[4]
+            self.misses += 1
+            return None
+
+    def put(self, filepath, key, digest, algorithm=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO hashes (path, algorithm, size, mtime_ns, inode, device, digest) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (filepath, algorithm or self.algorithm, *key, digest)
+            )
+            self.pending_writes += 1
+            if self.pending_writes >= self.commit_every:
+                self.conn.commit()
+                self.pending_writes = 0
+
+    def invalidate(self, filepath):
+        with self.lock:
+            self.conn.execute("DELETE FROM hashes WHERE path = ?", (filepath,))
+            self.conn.commit()
+
+    def prune(self, directory, seen_paths, listed_dirs):
+        # Drop entries below a scanned directory whose file was not seen in that scan. Only files
+        # directly in listed_dirs, the folders the walk read completely, can be known to be gone;
+        # folders it skipped or failed to read keep their entries.
+        prefix = os.path.join(directory, '')
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT path FROM hashes WHERE path >= ? AND path < ?",
+                (prefix, prefix + '\U0010ffff')
+            ).fetchall()
+            stale = [(path,) for (path,) in rows
+                     if path not in seen_paths and os.path.dirname(path) in listed_dirs]
+            self.conn.executemany("DELETE FROM hashes WHERE path = ?", stale)
+            self.conn.commit()
+        return len(stale)
+
+    def vacuum(self):
+        # Drop entries for files that no longer exist anywhere, then compact the database
+        with self.lock:
+            rows = self.conn.execute("SELECT DISTINCT path FROM hashes").fetchall()
+            stale = [(path,) for (path,) in rows if not os.path.lexists(path)]
+            self.conn.executemany("DELETE FROM hashes WHERE path = ?", stale)
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM hashes")
+            self.conn.commit()
+            self.conn.execute("VACUUM")
+            self.hits = 0
+            self.misses = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def format_stats(self, algorithm=None):
+        # algorithm names the hashes the lookups were for, when get() was given another one
+        return f"{algorithm or self.algorithm} cache hits: {self.hits}, misses: {self.misses}"
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending_writes = 0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
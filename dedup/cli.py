@@ -0,0 +1,369 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+from .actions import QUARANTINE_DIR, apply_action, create_journal, resume_action, rollback_action
+from .cache import HashCache
+from .engine import DuplicateFinder
+from .groups import KEEP_POLICIES
+from .hashing import DEFAULT_ALGORITHM, HASH_ALGORITHMS, MMAP_THRESHOLD, HashExecutor
+from .journal import ActionJournal, unfinished_journals
+from .manifest import ScanManifest
+from .scanner import SYMLINK_POLICIES
+from .progress import ProgressTracker, ScanCancelled, format_progress
+from .results import load_results, save_results
+from .similar import DEFAULT_THRESHOLD, IMAGE_EXTENSIONS, PERCEPTUAL_HASHES
+from .telemetry import ScanTelemetry, json_lines_sink
+from .utils import format_size
+
+PROGRESS_INTERVAL = 0.5
+
+def report_progress(tracker, stop):
+    # Redraws one stderr line from the tracker until stop is set, independent of how fast files arrive
+    while not stop.wait(PROGRESS_INTERVAL):
+        print(f"\r{format_progress(tracker.snapshot())[:120]:<120}", end='', file=sys.stderr, flush=True)
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m dedup',
+        description="Find duplicate files in one directory, or files with copies in several directories."
+    )
+    parser.add_argument('directories', nargs='*', metavar='DIR',
+                        help="One directory to deduplicate, or several directories (roots) to compare")
+    parser.add_argument('--no-subfolders', action='store_true',
+                        help="Only look at files directly inside the given directories")
+    parser.add_argument('--symlinks', choices=SYMLINK_POLICIES, default='skip',
+                        help="Skip symbolic links, include linked files, or also follow linked folders (default: skip)")
+    parser.add_argument('--one-filesystem', action='store_true',
+                        help="Do not descend into folders on another filesystem")
+    parser.add_argument('--keep', choices=list(KEEP_POLICIES), default=None,
+                        help="Which copy to keep of each group (default: oldest, largest with --similar)")
+    parser.add_argument('--delete-from', choices=['dir1', 'dir2'], default='dir2',
+                        help="Which directory loses its copy when comparing two directories (default: dir2)")
+    parser.add_argument('--priority', type=int, nargs='+', metavar='N',
+                        help="Root numbers (1 = first DIR) from most to least preferred for keeping a copy; "
+                             "copies in roots ranked below the kept one are removed. Unlisted roots follow "
+                             "in the order given (default: the order given, or --delete-from for two)")
+    parser.add_argument('--delete', action='store_true',
+                        help="Delete the duplicates instead of only listing them")
+    parser.add_argument('--link', choices=['hardlink', 'reflink'],
+                        help="Replace the duplicates with links to the kept copy instead of deleting them")
+    parser.add_argument('--quarantine', nargs='?', const='', metavar='DIR',
+                        help="Move the duplicates into DIR on the same filesystem instead of deleting them "
+                             f"(default: {QUARANTINE_DIR} in the DIR each file was found under); "
+                             "undo with --rollback")
+    parser.add_argument('--resume', nargs='?', const='', metavar='JOURNAL',
+                        help="Finish an interrupted --delete, --link or --quarantine run "
+                             "(default: the latest unfinished one)")
+    parser.add_argument('--rollback', metavar='JOURNAL',
+                        help="Move the files of a --quarantine run back where they were")
+    parser.add_argument('--abandon', metavar='JOURNAL',
+                        help="Give up an interrupted run, so it is no longer offered for --resume")
+    parser.add_argument('--json', action='store_true', help="Print the duplicate groups as JSON")
+    parser.add_argument('--hardlinks', action='store_true',
+                        help="Also list files found under several names: hard links, and symlinks unless skipped")
+    parser.add_argument('--similar', nargs='?', const='dhash', choices=PERCEPTUAL_HASHES, metavar='HASH',
+                        help="Find near-duplicate images by perceptual hash instead of identical files "
+                             f"({', '.join(PERCEPTUAL_HASHES)}, default: dhash)")
+    parser.add_argument('--threshold', type=int, default=DEFAULT_THRESHOLD,
+                        help=f"Differing hash bits up to which --similar treats images as copies "
+                             f"(default: {DEFAULT_THRESHOLD})")
+    parser.add_argument('--workers', type=int, default=None, help="Number of hashing workers")
+    parser.add_argument('--backend', choices=HashExecutor.BACKENDS, default='thread')
+    parser.add_argument('--algorithm', choices=list(HASH_ALGORITHMS), default=DEFAULT_ALGORITHM)
+    parser.add_argument('--mmap', action='store_true',
+                        help="Hash large files from a memory mapping, faster on local disks; not for network "
+                             "shares, where an I/O error or a file truncated during the scan crashes the run")
+    parser.add_argument('--no-cache', action='store_true', help="Do not use the persistent hash cache")
+    parser.add_argument('--cache-path', default=None, help="Location of the hash cache database")
+    parser.add_argument('--no-manifest', action='store_true',
+                        help="List every directory again instead of only the ones changed since the last scan")
+    parser.add_argument('--manifest-path', default=None, help="Location of the scan manifest database")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help="Forget all cached hashes and previous scans first")
+    parser.add_argument('--vacuum-cache', action='store_true',
+                        help="Drop cached hashes of files that no longer exist first")
+    parser.add_argument('--save', metavar='FILE',
+                        help="Save the scan result to FILE, to be opened again with --load or in the GUI")
+    parser.add_argument('--load', metavar='FILE',
+                        help="Use a result saved with --save instead of scanning")
+    parser.add_argument('--map-root', action='append', default=[], metavar='OLD=NEW',
+                        help="With --load, a root of the saved result is found at NEW on this machine")
+    parser.add_argument('--report', metavar='FILE',
+                        help="Write a JSON report of stage timings, bytes read, cache hits and the slowest "
+                             "files and folders")
+    parser.add_argument('--events', metavar='FILE',
+                        help="Stream every scan event as one JSON line to FILE while scanning")
+    parser.add_argument('--profile', action='store_true',
+                        help="Add a cProfile summary of the scanning thread to the report")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Add the peak and the top allocation sites (tracemalloc) to the report")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Report progress on stderr")
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.priority:
+        for root in args.priority:
+            if not 1 <= root <= len(args.directories):
+                parser.error(f"--priority {root}: there are {len(args.directories)} directories")
+    if args.resume is not None or args.rollback or args.abandon:
+        return run_journal(args)
+    if args.load:
+        if args.directories or args.similar:
+            parser.error("--load replaces scanning, it takes no directories or --similar")
+        root_map = {}
+        for mapping in args.map_root:
+            old, sep, new = mapping.partition('=')
+            if not sep or not old or not new:
+                parser.error(f"--map-root {mapping}: expected OLD=NEW")
+            root_map[old] = new
+    elif args.map_root:
+        parser.error("--map-root only applies to --load")
+    if not args.directories and not (args.clear_cache or args.vacuum_cache or args.load):
+        parser.error("no directory given")
+    if args.link and args.similar:
+        parser.error("similar images differ in content, they can only be deleted")
+    if sum(map(bool, (args.delete, args.link, args.quarantine is not None))) > 1:
+        parser.error("--delete, --link and --quarantine exclude each other")
+    for directory in args.directories:
+        if not os.path.isdir(directory):
+            parser.error(f"not a directory: {directory}")
+
+    def log(message):
+        print(message, file=sys.stderr)
+
+    if args.load:
+        try:
+            duplicates, header = load_results(args.load, root_map)
+        except (OSError, ValueError) as e:
+            log(f"Cannot open {args.load}: {str(e)}")
+            return 2
+        if args.link and duplicates.algorithm in PERCEPTUAL_HASHES:
+            log("similar images differ in content, they can only be deleted")
+            return 2
+        if args.verbose and header['stats']:
+            log(f"Saved scan: {header['stats']}")
+        hardlinks = [[first, *names] for first, names in duplicates.linked_names.items()]
+        return handle_duplicates(args, duplicates, hardlinks, log)
+
+    hash_cache = None
+    if not args.no_cache:
+        try:
+            hash_cache = HashCache(args.cache_path, algorithm=args.algorithm)
+        except (OSError, sqlite3.Error) as e:
+            log(f"Hash cache unavailable: {str(e)}")
+    manifest = None
+    if not args.no_manifest and not args.similar:
+        try:
+            manifest = ScanManifest(args.manifest_path)
+        except (OSError, sqlite3.Error) as e:
+            log(f"Scan manifest unavailable: {str(e)}")
+    if args.clear_cache:
+        if hash_cache is not None:
+            hash_cache.clear()
+        if manifest is not None:
+            manifest.forget()
+    if hash_cache is not None and args.vacuum_cache:
+        log(f"Removed {hash_cache.vacuum()} stale hash cache entries")
+    if not args.directories:
+        return 0
+
+    events = None
+    if args.events:
+        try:
+            events = open(args.events, 'w')
+        except OSError as e:
+            parser.error(f"cannot write events: {str(e)}")
+    telemetry = ScanTelemetry(sink=json_lines_sink(events) if events else None,
+                              profile=args.profile, trace_memory=args.trace_memory)
+
+    tracker = ProgressTracker()
+    stop_reporting = threading.Event()
+    if args.verbose:
+        threading.Thread(target=report_progress, args=(tracker, stop_reporting), daemon=True).start()
+
+    # --delete-from is the priority of two roots: the directory that loses its copies ranks last
+    priority = args.priority
+    if priority is None and len(args.directories) == 2 and args.delete_from == 'dir1':
+        priority = [2, 1]
+
+    finder = DuplicateFinder(include_subfolders=not args.no_subfolders, workers=args.workers,
+                             backend=args.backend, algorithm=args.algorithm,
+                             mmap_threshold=MMAP_THRESHOLD if args.mmap else None,
+                             hash_cache=hash_cache, progress=tracker, manifest=manifest,
+                             symlinks=args.symlinks, one_filesystem=args.one_filesystem, telemetry=telemetry,
+                             log=log if args.verbose else lambda message: None, error_log=log)
+    try:
+        if args.similar:
+            duplicates = finder.compare_similar_images(args.directories, IMAGE_EXTENSIONS, args.similar,
+                                                       args.threshold, keep=args.keep or 'largest',
+                                                       priority=priority)
+        elif len(args.directories) == 1:
+            duplicates = finder.compare_single_directory(args.directories[0], keep=args.keep or 'oldest')
+        else:
+            duplicates = finder.compare_directories(args.directories, keep=args.keep or 'oldest',
+                                                    priority=priority)
+    except (RuntimeError, ValueError) as e:
+        log(str(e))
+        return 2
+    except (KeyboardInterrupt, ScanCancelled):
+        # The finder saved a checkpoint, running the same command again resumes from it
+        if manifest is not None or hash_cache is not None:
+            log("Interrupted, the next scan of these directories resumes from the last checkpoint")
+        else:
+            log("Interrupted")
+        return 130
+    finally:
+        stop_reporting.set()
+        if hash_cache is not None:
+            hash_cache.close()
+        if manifest is not None:
+            manifest.close()
+        if events is not None:
+            events.close()
+    if args.verbose:
+        log(f"Timings: {telemetry.format_summary()}")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(telemetry.report(), f, indent=2)
+    if args.save:
+        try:
+            save_results(args.save, duplicates, finder.stats_text)
+        except OSError as e:
+            log(f"Cannot save the result: {str(e)}")
+    return handle_duplicates(args, duplicates, finder.hardlink_groups(), log)
+
+def handle_duplicates(args, duplicates, hardlinks, log):
+    # Lists the duplicates of a scan or a loaded result and applies the requested action
+    table = duplicates.table
+    deletions = list(duplicates.deletions())
+    if not args.hardlinks:
+        hardlinks = []
+    if args.json:
+        to_delete = {file_id for file_id, _ in deletions}
+        groups = [{
+            'digest': group.digest.hex() if group.digest else None,
+            'size': group.size,
+            'reclaimable': duplicates.reclaimable_bytes(group),
+            'files': [table.path(name) for i in group.members for name in duplicates.names(i)],
+            # Root number of each of the files, 1 for the first entry of 'roots'
+            'file_roots': [duplicates.root_of(name) for i in group.members for name in duplicates.names(i)],
+            'delete': [table.path(name) for i in group.members for name in duplicates.names(i)
+                       if name in to_delete]
+        } for group in duplicates]
+        output = {'algorithm': duplicates.algorithm, 'roots': duplicates.root_paths,
+                  'priority': duplicates.priority, 'groups': groups}
+        if args.hardlinks:
+            output['hardlinks'] = [{
+                'size': table.sizes[names[0]],
+                'links': table.nlinks[names[0]],
+                'files': [table.path(i) for i in names]
+            } for names in hardlinks]
+        print(json.dumps(output, indent=2))
+    else:
+        # One line per duplicate: the file that would be deleted, then a copy that is kept
+        for delete_id, keep_id in deletions:
+            print(f"{table.path(delete_id)}\t{table.path(keep_id)}")
+        # Hard links free nothing when removed, they are listed apart, one inode per line
+        for names in hardlinks:
+            print("linked\t" + "\t".join(table.path(i) for i in names))
+
+    if not (args.delete or args.link or args.quarantine is not None):
+        log(f"Found {len(deletions)} duplicate files in {len(duplicates)} groups, "
+            f"{format_size(duplicates.reclaimable_bytes())} reclaimable")
+        linked = sum(map(len, duplicates.linked_names.values()))
+        if linked:
+            log(f"{linked} further names of already linked files were not read")
+        return 0
+
+    action = 'quarantine' if args.quarantine is not None else args.link or 'delete'
+    # A quarantine has to be on the filesystem of the files moved into it, so without a folder
+    # given every root gets its own, and its own journal
+    runs = {}
+    for delete_id, keep_id in deletions:
+        if action != 'quarantine' or args.quarantine:
+            quarantine_root = args.quarantine or None
+        else:
+            quarantine_root = os.path.join(duplicates.root_path(delete_id), QUARANTINE_DIR)
+        runs.setdefault(quarantine_root, []).append(
+            (table.path(delete_id), table.path(keep_id), table.stat_key(delete_id)))
+    results = []
+    for quarantine_root, jobs in runs.items():
+        # Every outcome goes to the journal as it happens, so an interrupted run can be resumed
+        with create_journal(action, jobs, quarantine_root) as journal:
+            try:
+                results.extend(apply_action(action, jobs, args.workers, quarantine=journal.quarantine,
+                                            journal=journal))
+            except KeyboardInterrupt:
+                log(f"Interrupted, finish with --resume {journal.path}")
+                return 130
+        if action == 'quarantine':
+            log(f"Moved to {journal.quarantine}, undo with --rollback {journal.path}")
+        if journal.pending():
+            log(f"Retry the files that failed with --resume {journal.path}")
+    return report_results(action, results, log)
+
+def report_results(action, results, log):
+    errors = 0
+    freed = 0
+    processed = 0
+    for result in results:
+        if result is None:
+            continue
+        size, error = result
+        if error is not None:
+            errors += 1
+            log(f"Error processing {error}")
+            continue
+        processed += 1
+        freed += size
+    log(f"Processed {processed} files with {action}, {format_size(freed)} freed, {errors} errors")
+    return 1 if errors else 0
+
+def run_journal(args):
+    # --resume, --rollback and --abandon only need the journal of the earlier run
+    def log(message):
+        print(message, file=sys.stderr)
+
+    if args.abandon:
+        try:
+            with ActionJournal.open(args.abandon) as journal:
+                summary = journal.summary()
+                journal.abandon()
+        except (OSError, ValueError) as e:
+            log(f"Cannot use journal {args.abandon}: {str(e)}")
+            return 2
+        log(f"Abandoned {summary['action']} run {summary['run']} with {summary['pending']} of "
+            f"{summary['jobs']} files left")
+        return 0
+    if args.rollback:
+        path, run = args.rollback, rollback_action
+    else:
+        path, run = args.resume, resume_action
+        if not path:
+            unfinished = unfinished_journals()
+            if not unfinished:
+                log("No unfinished run to resume")
+                return 0
+            path = unfinished[0]
+    try:
+        journal, results = run(path, args.workers)
+    except (OSError, ValueError) as e:
+        log(f"Cannot use journal {path}: {str(e)}")
+        return 2
+    except KeyboardInterrupt:
+        log(f"Interrupted, finish with --resume {path}" if run is resume_action else "Interrupted")
+        return 130
+    if run is rollback_action:
+        restored = sum(1 for result in results if result is not None and result[1] is None)
+        for result in results:
+            if result is not None and result[1] is not None:
+                log(f"Error restoring {result[1]}")
+        log(f"Restored {restored} files from quarantine")
+        return 1 if restored < sum(1 for result in results if result is not None) else 0
+    return report_results(journal.action, results, log)
@@ -0,0 +1,418 @@
+import os
+import threading
+import time
+
+from .hashing import DEFAULT_ALGORITHM, HashExecutor, StagedHasher
+from .groups import DuplicateIndex
+from .progress import ProgressTracker, ScanCancelled, check_cancelled
+from .records import FileTable
+from .scanner import WalkOptions, scan_directory, scan_incremental
+from .telemetry import ScanTelemetry
+from .similar import (
+    DEFAULT_PERCEPTUAL_HASH, DEFAULT_THRESHOLD, HASH_BATCH_SIZE, HASH_SIZE, hash_pixels, read_pixels,
+    require_numpy, similar_groups,
+)
+
+# Seconds between checkpoints of the digests found so far; a checkpoint that took long stretches
+# the interval, so writing them never takes more than a tenth of the scan
+CHECKPOINT_INTERVAL = 60.0
+
+# Root numbers are stored in a byte per file
+MAX_ROOTS = 255
+
+def normalize_roots(directories):
+    # Absolute paths without a trailing separator, the form the walk joins every path below a
+    # root onto. The manifest finds a directory's subdirectories by their parent path, so "/data/"
+    # and "data" have to reach it as the same "/data" the walk produces.
+    return [os.path.abspath(directory) for directory in directories]
+
+def check_roots(directories):
+    # A root given twice or inside another one would be scanned twice, and every file in it
+    # would look like a copy of itself
+    if len(directories) > MAX_ROOTS:
+        raise ValueError(f"At most {MAX_ROOTS} directories can be compared at once")
+    real = [os.path.join(os.path.realpath(directory), '') for directory in directories]
+    for i, path in enumerate(real):
+        for j, other in enumerate(real):
+            if i != j and path.startswith(other):
+                relation = "the same as" if path == other else "inside"
+                raise ValueError(f"{directories[i]} is {relation} {directories[j]}")
+
+class DuplicateFinder:
+    def __init__(self, include_subfolders=True, workers=None, backend='thread',
+                 algorithm=DEFAULT_ALGORITHM, hash_cache=None, stage_options=None,
+                 progress=None, log=print, manifest=None, symlinks='skip', one_filesystem=False,
+                 telemetry=None, cancel=None, mmap_threshold=None, error_log=None):
+        self.include_subfolders = include_subfolders
+        self.symlinks = symlinks
+        self.one_filesystem = one_filesystem
+        self.workers = workers
+        self.backend = backend
+        self.algorithm = algorithm
+        self.mmap_threshold = mmap_threshold
+        self.hash_cache = hash_cache
+        self.stage_options = stage_options or {}
+        self.progress = progress or ProgressTracker()
+        self.log = log
+        # Files and folders that could not be read go here, so a quiet log still reports them
+        self.error_log = error_log or log
+        self.manifest = manifest
+        self.telemetry = telemetry or ScanTelemetry()
+        # Set from any thread to stop the comparison, see cancel()
+        self.cancel_event = cancel or threading.Event()
+        self.next_checkpoint = None
+        self.checkpoint_seconds = 0.0
+        self.stats_text = ""
+        self.table = FileTable()
+        # [root, first file id, end file id, PreviousScan or None, scan start] per scanned directory
+        self.scanned_roots = []
+        # Further names of an inode that was already listed -> the file id it was first listed as
+        self.links = {}
+
+        if hash_cache is not None:
+            hash_cache.algorithm = algorithm
+
+    def cancel(self):
+        # The scanning thread stops at the next file with ScanCancelled, after a last checkpoint
+        self.cancel_event.set()
+
+    def walk_options(self):
+        return WalkOptions(self.include_subfolders, self.symlinks, self.one_filesystem, self.log, self.telemetry,
+                           self.error_log)
+
+    def record_link(self, file_id, inode_ids):
+        # Removing another name of an inode frees nothing, so only the first name seen is hashed
+        # and reported; returns True for a further name. Once symlinks are read, a file can also
+        # be reached under several paths without being hard linked.
+        table = self.table
+        if (table.nlinks[file_id] < 2 and self.symlinks == 'skip') or not table.inodes[file_id]:
+            return False
+        first = inode_ids.setdefault((table.devices[file_id], table.inodes[file_id]), file_id)
+        if first == file_id:
+            return False
+        self.links[file_id] = first
+        return True
+
+    def hardlink_groups(self):
+        # [first name, further names...] per inode listed under several names
+        groups = {}
+        for file_id, first in self.links.items():
+            groups.setdefault(first, [first]).append(file_id)
+        return list(groups.values())
+
+    def format_link_stats(self):
+        if not self.links:
+            return ""
+        inodes = len(set(self.links.values()))
+        return f"; {len(self.links)} linked names of {inodes} files skipped"
+
+    def create_hasher(self, executor, keep_group=None):
+        store_hash = None
+        if self.hash_cache is not None:
+            self.hash_cache.reset_stats()
+            table = self.table
+            store_hash = lambda i: self.hash_cache.put(table.path(i), table.stat_key(i), table.digest(i))
+        return StagedHasher(self.table, executor, keep_group=keep_group, store_hash=store_hash,
+                            algorithm=self.algorithm, mmap_threshold=self.mmap_threshold,
+                            telemetry=self.telemetry, cancel=self.cancel_event, log=self.log,
+                            error_log=self.error_log, **self.stage_options)
+
+    def queue_candidate(self, file_id, hasher):
+        # Unchanged files take their digest from the manifest or the cache, so no stage has to read them
+        if self.table.has_digest(file_id):
+            return
+        if self.hash_cache is not None:
+            digest = self.hash_cache.get(self.table.path(file_id), self.table.stat_key(file_id))
+            if digest is not None:
+                self.table.set_digest(file_id, digest)
+                return
+        hasher.prefetch(file_id)
+
+    def scan(self, directories, hasher):
+        # Single pass over every directory. Files are grouped by size as they are listed, and as
+        # soon as a size collides its files are handed to the hasher while the walk continues.
+        table = self.table
+        size_map = {}
+        queued = {}
+        inode_ids = {}
+        self.scanned_roots = []
+        self.links = {}
+        resumed = 0
+        for side, directory in enumerate(directories, 1):
+            seen_paths = set()
+            listed = set()
+            files_found = 0
+            first_id = len(table)
+
+            def progress(dirs_done, dirs_found):
+                self.progress.update(dirs_done, dirs_found,
+                                     f"Scanning {directory}: {files_found} files in {dirs_done} of {dirs_found} folders")
+
+            for dirpath, name, st, digest in self.walk(directory, progress, listed):
+                check_cancelled(self.cancel_event)
+                file_id = table.add(dirpath, name, st, side)
+                if digest is not None:
+                    table.set_digest(file_id, digest)
+                    resumed += 1
+                files_found += 1
+                if self.hash_cache is not None:
+                    seen_paths.add(table.path(file_id))
+
+                if self.record_link(file_id, inode_ids):
+                    continue
+
+                # Most sizes are unique, they only keep a bare file id until a second file shows up
+                size = st.st_size
+                group = size_map.get(size)
+                if group is None:
+                    size_map[size] = file_id
+                    continue
+                if not isinstance(group, list):
+                    group = size_map[size] = [group]
+                group.append(file_id)
+                # Groups only grow here, so once a group qualifies every later file is a candidate too
+                if size in queued or hasher.keep_group(group):
+                    for candidate in group[queued.get(size, 0):]:
+                        self.queue_candidate(candidate, hasher)
+                    queued[size] = len(group)
+
+            self.scanned_roots[-1][1:3] = [first_id, len(table)]
+            if self.hash_cache is not None:
+                pruned = self.hash_cache.prune(directory, seen_paths, listed)
+                if pruned:
+                    self.log(f"Removed {pruned} stale hash cache entries below {directory}")
+
+        # Duplicate groups are not carried over from the previous scan, only digests are. The
+        # groups are rebuilt from them in memory: unchanged files are split on their stored digest
+        # without reading, so only new and modified files cost I/O, and removed files are simply
+        # absent. Patching stored groups would save that in-memory pass but not a single read.
+        if resumed:
+            self.log(f"Reusing {resumed} digests from the previous scan or checkpoint")
+        self.telemetry.count('digests_reused', resumed)
+        # Files with a unique size cannot have a duplicate and were never read
+        return [size_map[size] for size in queued]
+
+    def walk(self, directory, progress, listed=None):
+        # (directory, name, stat, digest or None) per file, through the manifest when there is one.
+        # Directories read completely are added to listed.
+        options = self.walk_options()
+        options.listed = listed
+        # The end id stays None until the walk of the root is complete
+        if self.manifest is None:
+            self.scanned_roots.append([directory, 0, None, None, 0])
+            for dirpath, name, st in scan_directory(directory, progress=progress, options=options):
+                yield dirpath, name, st, None
+            return
+        previous = self.manifest.load(directory, options.signature(), self.algorithm)
+        self.scanned_roots.append([directory, 0, None, previous, time.time_ns()])
+        yield from scan_incremental(directory, previous, progress, options)
+
+    def save_manifest(self, final=True):
+        # Stores every scanned root with the digests found for it, once hashing is done, or as a
+        # checkpoint while it runs. A root whose walk did not finish is left as it was: its
+        # directory list would be incomplete, and a later scan would trust it.
+        for directory, first_id, end_id, previous, started_ns in self.scanned_roots:
+            if previous is None or end_id is None:
+                continue
+            self.manifest.save(directory, self.walk_options().signature(), self.algorithm, self.table,
+                               range(first_id, end_id), previous.dir_mtimes, started_ns)
+            if final:
+                self.log(f"Incremental scan of {previous.format_stats(end_id - first_id)}")
+
+    def checkpoint(self):
+        # Persists every digest found so far, so a cancelled or crashed scan resumes from here
+        start = time.perf_counter()
+        with self.telemetry.stage('checkpoint'):
+            if self.hash_cache is not None:
+                self.hash_cache.flush()
+            if self.manifest is not None:
+                self.save_manifest(final=False)
+        self.checkpoint_seconds = time.perf_counter() - start
+        self.next_checkpoint = time.perf_counter() + max(CHECKPOINT_INTERVAL, 10 * self.checkpoint_seconds)
+
+    def checkpoint_if_due(self):
+        if self.next_checkpoint is None:
+            self.next_checkpoint = time.perf_counter() + CHECKPOINT_INTERVAL
+        elif time.perf_counter() >= self.next_checkpoint:
+            self.checkpoint()
+
+    def find_duplicate_groups(self, directories, keep_group=None):
+        # Workers only read and hash, results are merged into the groups on this thread
+        self.next_checkpoint = None
+        try:
+            with HashExecutor(self.workers, self.backend) as executor:
+                hasher = self.create_hasher(executor, keep_group)
+                with self.telemetry.stage('scan'):
+                    size_groups = self.scan(directories, hasher)
+
+                def progress(stage, processed, total, file_id, bytes_read):
+                    self.progress.add(1, bytes_read)
+                    self.progress.update(processed, total,
+                                         f"Hashing ({stage}) file {processed} of {total}: {self.table.name(file_id)}")
+                    self.checkpoint_if_due()
+
+                groups = hasher.find_duplicates(size_groups, progress)
+        except BaseException as e:
+            # Cancelled, interrupted or failed: keep what was hashed for the next run
+            try:
+                self.checkpoint()
+            except Exception as checkpoint_error:
+                self.error_log(f"Could not save a checkpoint: {str(checkpoint_error)}")
+            if isinstance(e, ScanCancelled):
+                self.log("Scan cancelled, the digests found so far are kept for the next scan")
+            raise
+
+        stats_text = hasher.format_stats()
+        if self.hash_cache is not None:
+            self.hash_cache.flush()
+            self.telemetry.cache_lookups(self.hash_cache.hits, self.hash_cache.misses)
+            stats_text += f"; {self.hash_cache.format_stats()}"
+        stats_text += f"; {hasher.format_throughput()}"
+        stats_text += self.format_link_stats()
+        self.telemetry.count('linked_names_skipped', len(self.links))
+        if self.manifest is not None:
+            with self.telemetry.stage('manifest'):
+                self.save_manifest()
+        self.stats_text = stats_text
+        self.log(f"Bytes read per stage: {stats_text}")
+        return groups
+
+    def compare_single_directory(self, directory, keep='oldest'):
+        # Every hash group becomes one duplicate group, the keep policy picks its original
+        directory, = normalize_roots([directory])
+        with self.telemetry.session('single_directory', directories=[directory]):
+            file_groups = self.find_duplicate_groups([directory])
+            with self.telemetry.stage('match'):
+                duplicates = DuplicateIndex(self.table, self.algorithm, keep, links=self.links,
+                                            root_paths=[directory])
+                for file_group in file_groups:
+                    duplicates.add_group(file_group, self.table.digest(file_group[0]))
+        return duplicates
+
+    def compare_two_directories(self, dir1, dir2, keep='oldest'):
+        return self.compare_directories([dir1, dir2], keep)
+
+    def compare_directories(self, directories, keep='oldest', priority=None):
+        # Files with copies in more than one of the directories. All roots go through one scan
+        # and one hashing pass into the same table, so every file is read once however many
+        # roots there are, and each group member carries its root number (1 = first directory).
+        # priority orders root numbers from most to least preferred for the kept copy.
+        directories = normalize_roots(directories)
+        check_roots(directories)
+        sides = self.table.sides
+
+        # A group is only worth refining while it still has files from two roots. Groups keep
+        # scan order, so the first and last file tell whether more than one root is present.
+        def keep_group(group):
+            return sides[group[0]] != sides[group[-1]]
+
+        # Copies inside one directory are not reported, only copies across directories. Names that
+        # already share an inode are not copies either, they only show up in hardlink_groups().
+        with self.telemetry.session('directories', directories=list(directories)):
+            file_groups = self.find_duplicate_groups(directories, keep_group)
+            with self.telemetry.stage('match'):
+                duplicates = DuplicateIndex(self.table, self.algorithm, keep, roots=len(directories),
+                                            links=self.links, priority=priority, root_paths=directories)
+                for file_group in file_groups:
+                    duplicates.add_group(file_group, self.table.digest(file_group[0]))
+        return duplicates
+
+    def compare_similar_images(self, directories, extensions, method=DEFAULT_PERCEPTUAL_HASH,
+                               threshold=DEFAULT_THRESHOLD, keep='largest', priority=None):
+        # Near duplicates instead of identical files: every image gets a perceptual hash and
+        # images within threshold differing bits of each other end up in the same group
+        directories = normalize_roots(directories)
+        check_roots(directories)
+        with self.telemetry.session('similar_images', directories=list(directories), method=method):
+            require_numpy()
+            table = self.table
+            images = []
+            inode_ids = {}
+            self.links = {}
+            with self.telemetry.stage('scan'):
+                for side, directory in enumerate(directories, 1):
+                    def progress(dirs_done, dirs_found):
+                        self.progress.update(dirs_done, dirs_found, f"Scanning {directory}: {len(images)} images "
+                                                                    f"in {dirs_done} of {dirs_found} folders")
+
+                    for dirpath, name, st in scan_directory(directory, progress=progress, options=self.walk_options()):
+                        check_cancelled(self.cancel_event)
+                        if name.lower().endswith(extensions):
+                            file_id = table.add(dirpath, name, st, side)
+                            if not self.record_link(file_id, inode_ids):
+                                images.append(file_id)
+
+            # Perceptual hashes are cached next to the content digests, under their own algorithm name
+            cache_name = f"{method}{HASH_SIZE}"
+            codes = {}
+            jobs = []
+            if self.hash_cache is not None:
+                self.hash_cache.reset_stats()
+            for file_id in images:
+                code = None
+                if self.hash_cache is not None:
+                    code = self.hash_cache.get(table.path(file_id), table.stat_key(file_id), cache_name)
+                if code is not None:
+                    codes[file_id] = code
+                else:
+                    jobs.append(file_id)
+
+            errors = 0
+            with self.telemetry.stage('image_hash'), HashExecutor(self.workers, self.backend) as executor:
+                batch_ids, batch_pixels = [], []
+
+                def hash_batch():
+                    for file_id, code in zip(batch_ids, hash_pixels(batch_pixels, method, HASH_SIZE)):
+                        codes[file_id] = code
+                        if self.hash_cache is not None:
+                            self.hash_cache.put(table.path(file_id), table.stat_key(file_id), code, cache_name)
+                    batch_ids.clear()
+                    batch_pixels.clear()
+
+                args = [(table.path(file_id), method, HASH_SIZE) for file_id in jobs]
+                for processed, (index, pixels, error) in enumerate(executor.map(read_pixels, args), 1):
+                    if self.cancel_event.is_set():
+                        # Hashes of the images read so far go to the cache for the next run
+                        if batch_ids:
+                            hash_batch()
+                        if self.hash_cache is not None:
+                            self.hash_cache.flush()
+                        raise ScanCancelled()
+                    file_id = jobs[index]
+                    self.progress.add(1, table.sizes[file_id])
+                    self.progress.update(processed, len(jobs),
+                                         f"Hashing image {processed} of {len(jobs)}: {table.name(file_id)}")
+                    if error is not None:
+                        errors += 1
+                        self.error_log(f"Error reading image {table.path(file_id)}: {str(error)}")
+                        self.telemetry.file_error('image_hash', table.path(file_id), error)
+                        continue
+                    batch_ids.append(file_id)
+                    batch_pixels.append(pixels)
+                    if len(batch_ids) >= HASH_BATCH_SIZE:
+                        hash_batch()
+                if batch_ids:
+                    hash_batch()
+
+            file_ids = [file_id for file_id in images if file_id in codes]
+            values = [int.from_bytes(codes[file_id], 'big') for file_id in file_ids]
+            self.progress.update(0, 1, f"Searching {len(values)} image hashes within {threshold} bits")
+            with self.telemetry.stage('match'):
+                duplicates = DuplicateIndex(table, method, keep, roots=len(directories), links=self.links,
+                                            priority=priority, root_paths=directories)
+                for positions in similar_groups(values, HASH_SIZE * HASH_SIZE, threshold):
+                    group = duplicates.add_group([file_ids[p] for p in positions])
+                    if duplicates.roots > 1 and not duplicates.spans_roots(group):
+                        duplicates.remove_group(group.group_id)
+
+            stats_text = (f"{method}: {len(jobs) - errors} images hashed, {len(images) - len(jobs)} cached, "
+                          f"{errors} unreadable, threshold {threshold} bits{self.format_link_stats()}")
+            if self.hash_cache is not None:
+                self.hash_cache.flush()
+                self.telemetry.cache_lookups(self.hash_cache.hits, self.hash_cache.misses)
+                stats_text += f"; {self.hash_cache.format_stats(cache_name)}"
+            self.telemetry.count('images_hashed', len(jobs) - errors)
+            self.telemetry.count('images_cached', len(images) - len(jobs))
+            self.stats_text = stats_text
+            self.log(stats_text)
+        return duplicates
@@ -0,0 +1,190 @@
+from .records import FileTable
+
+# Which file of a duplicate group is kept, the others are reported as duplicates of it.
+# Keys are computed from file ids into a FileTable; the smallest key wins.
+KEEP_POLICIES = {
+    'oldest': lambda table, i: table.ctimes[i],
+    'newest': lambda table, i: -table.ctimes[i],
+    'shortest-path': lambda table, i: (len(table.path(i)), table.path(i)),
+    'longest-path': lambda table, i: (-len(table.path(i)), table.path(i)),
+    # Near duplicates differ in size, the largest copy usually has the most detail
+    'largest': lambda table, i: (-table.sizes[i], table.ctimes[i]),
+}
+
+class DuplicateGroup:
+    __slots__ = ('group_id', 'digest', 'size', 'members', 'keep')
+
+    def __init__(self, group_id, digest, size, file_ids):
+        self.group_id = group_id
+        self.digest = digest
+        self.size = size
+        # A dict used as an ordered set, so members are removed in constant time
+        self.members = dict.fromkeys(file_ids)
+        self.keep = None
+
+    def __len__(self):
+        return len(self.members)
+
+    def duplicates(self):
+        return [i for i in self.members if i != self.keep]
+
+class DuplicateIndex:
+    # Every set of identical files found by a scan, addressed by group id, plus a reverse
+    # file id -> group id map so single files can be dropped without searching.
+    # With several roots, a file's side in the table is its root number (1 = first root), and
+    # the kept copy of a group is the one in the most preferred root present: priority lists
+    # root numbers from most to least preferred, roots it leaves out follow in root order.
+    def __init__(self, table=None, algorithm=None, keep_policy='oldest', roots=1, links=None, priority=None,
+                 root_paths=None):
+        self.table = table if table is not None else FileTable()
+        self.algorithm = algorithm
+        self.keep_policy = keep_policy
+        self.roots = roots
+        self.root_paths = list(root_paths) if root_paths is not None else []
+        for root in priority or ():
+            if not 1 <= root <= roots:
+                raise ValueError(f"No root number {root}, there are {roots} roots")
+        self.priority = []
+        for root in [*(priority or ()), *range(1, roots + 1)]:
+            if root not in self.priority:
+                self.priority.append(root)
+        # Root number -> rank, the lowest rank present keeps its copy
+        self.root_rank = {root: rank for rank, root in enumerate(self.priority)}
+        # Groups hold one name per inode; further names of a member -> file id of that member
+        self.linked_names = {}
+        for file_id, first in (links or {}).items():
+            self.linked_names.setdefault(first, []).append(file_id)
+        self.groups = {}
+        self.file_groups = {}
+        self.next_group_id = 0
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __iter__(self):
+        return iter(self.groups.values())
+
+    def get(self, group_id):
+        return self.groups[group_id]
+
+    def group_of(self, file_id):
+        group_id = self.file_groups.get(file_id)
+        return None if group_id is None else self.groups[group_id]
+
+    def add_group(self, file_ids, digest=None):
+        table = self.table
+        group = DuplicateGroup(self.next_group_id, digest, table.sizes[file_ids[0]], file_ids)
+        self.next_group_id += 1
+        self.groups[group.group_id] = group
+        for file_id in file_ids:
+            self.file_groups[file_id] = group.group_id
+        self.choose_keep(group)
+        return group
+
+    def keep_key(self, file_id):
+        key = KEEP_POLICIES[self.keep_policy](self.table, file_id)
+        if self.roots == 1:
+            return key
+        return self.root_rank[self.table.sides[file_id]], key
+
+    def choose_keep(self, group):
+        group.keep = min(group.members, key=self.keep_key)
+
+    def set_keep_policy(self, keep_policy):
+        self.keep_policy = keep_policy
+        for group in self.groups.values():
+            self.choose_keep(group)
+
+    def remove_file(self, file_id):
+        # Constant time, apart from re-electing the kept file when that one goes
+        group_id = self.file_groups.pop(file_id, None)
+        if group_id is None:
+            return
+        group = self.groups[group_id]
+        del group.members[file_id]
+        if len(group.members) < 2 or (self.roots > 1 and not self.spans_roots(group)):
+            self.remove_group(group_id)
+        elif group.keep == file_id:
+            self.choose_keep(group)
+
+    def remove_group(self, group_id):
+        group = self.groups.pop(group_id)
+        for file_id in group.members:
+            self.file_groups.pop(file_id, None)
+
+    def spans_roots(self, group):
+        sides = self.table.sides
+        first = sides[next(iter(group.members))]
+        return any(sides[i] != first for i in group.members)
+
+    def root_of(self, file_id):
+        # Root number of a file, 1 for the first root
+        return self.table.sides[file_id]
+
+    def root_path(self, file_id):
+        return self.root_paths[self.table.sides[file_id] - 1]
+
+    def redundant(self, group):
+        # Members that go when the group is cleaned up: with several roots, copies in the kept
+        # file's root stay, as they are not duplicates across roots
+        if self.roots == 1:
+            return group.duplicates()
+        sides = self.table.sides
+        keep_root = sides[group.keep]
+        return [i for i in group.members if sides[i] != keep_root]
+
+    def names(self, file_id):
+        # Every scanned name of the file's inode, the file itself first
+        return [file_id, *self.linked_names.get(file_id, ())]
+
+    def duplicate_count(self):
+        return sum(len(self.redundant(group)) for group in self.groups.values())
+
+    def reclaimable_bytes(self, group=None):
+        # Sizes of everything deletions() would remove; near-duplicate groups mix file sizes.
+        # A copy with hard links outside the scanned folders stays on disk, it frees nothing.
+        table = self.table
+        groups = self.groups.values() if group is None else [group]
+        return sum(table.sizes[i] for group in groups for i in self.redundant(group)
+                   if table.nlinks[i] <= 1 + len(self.linked_names.get(i, ())))
+
+    def deletions(self, delete_side=None):
+        # (file to delete, copy that stays) for every redundant file. With one root the keep
+        # policy decides. With several roots the root priority does: every root ranked below the
+        # kept copy's root loses its copies. Given a delete_side, every copy in that root goes
+        # instead and the best copy of the other roots stays.
+        sides = self.table.sides
+        for group in self.groups.values():
+            if self.roots == 1 or delete_side is None:
+                for file_id in self.redundant(group):
+                    for name in self.names(file_id):
+                        yield name, group.keep
+                continue
+            if sides[group.keep] == delete_side:
+                keep = min((i for i in group.members if sides[i] != delete_side), key=self.keep_key)
+            else:
+                keep = group.keep
+            for file_id in group.members:
+                for name in self.names(file_id):
+                    if sides[name] == delete_side and name != keep:
+                        yield name, keep
+
+    def pairs(self):
+        # (group id, left file, right file) for side by side review; every member shows up once.
+        # Groups are visited in creation order, so the pairs come sorted by group id.
+        for group in self.groups.values():
+            yield from self.group_pairs(group)
+
+    def group_pairs(self, group):
+        # The pairs of one group. With one root the kept file is on the left. With several roots
+        # the left side holds files of the kept copy's root and the right side files of the
+        # others; with two roots in their default priority that is a directory 1 file against a
+        # directory 2 file.
+        if self.roots == 1:
+            return [(group.group_id, group.keep, file_id) for file_id in group.duplicates()]
+        sides = self.table.sides
+        keep_root = sides[group.keep]
+        left = [i for i in group.members if sides[i] == keep_root]
+        right = [i for i in group.members if sides[i] != keep_root]
+        return ([(group.group_id, left[0], file_id) for file_id in right]
+                + [(group.group_id, file_id, right[0]) for file_id in left[1:]])
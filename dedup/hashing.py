@@ -0,0 +1,401 @@
+import errno
+import os
+import hashlib
+import mmap
+import stat
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from .progress import check_cancelled
+from .records import stat_key
+from .utils import format_size
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# Digest constructors by name. Digests of different algorithms are never compared or cached together.
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': lambda: hashlib.blake2b(digest_size=16),
+}
+if xxhash is not None:
+    HASH_ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+    HASH_ALGORITHMS['xxh64'] = xxhash.xxh64
+if blake3 is not None:
+    HASH_ALGORITHMS['blake3'] = blake3.blake3
+
+DEFAULT_ALGORITHM = 'md5'
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Once mapping is turned on, files from this size on are hashed straight from a memory mapping
+# instead of being copied through the read buffer; below it the mapping setup costs more than the
+# copy it saves. It is off by default: where a read returns an error, a mapped page that cannot be
+# read (an I/O error, or a file truncated on a network share) kills the process with SIGBUS.
+MMAP_THRESHOLD = 64 * 1024 * 1024
+# Bytes handed to the digest per update, large enough that hashlib releases the GIL for each
+MMAP_CHUNK_SIZE = 8 * 1024 * 1024
+
+_read_buffers = threading.local()
+
+def get_read_buffer(size=READ_BUFFER_SIZE):
+    # One reusable buffer per thread, so reading a chunk never allocates a new bytes object
+    buf = getattr(_read_buffers, 'buf', None)
+    if buf is None or len(buf) != size:
+        buf = memoryview(bytearray(size))
+        _read_buffers.buf = buf
+    return buf
+
+def hash_ranges(filepath, ranges, algorithm=DEFAULT_ALGORITHM):
+    # Hash the given (offset, length) regions of a file into a single digest
+    hasher = HASH_ALGORITHMS[algorithm]()
+    buf = get_read_buffer()
+    bytes_read = 0
+    with open(filepath, "rb", buffering=0) as f:
+        for offset, length in ranges:
+            f.seek(offset)
+            remaining = length
+            while remaining > 0:
+                n = f.readinto(buf[:min(len(buf), remaining)])
+                if not n:
+                    break
+                hasher.update(buf[:n])
+                remaining -= n
+                bytes_read += n
+    return hasher.digest(), bytes_read
+
+def advise_sequential(fd, size):
+    # Lets the kernel read ahead aggressively and drop pages behind the reader
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+def hash_mapped(f, st, hasher):
+    # Feeds memoryview slices of a read-only mapping to the digest, no bytes are copied.
+    # Raises OSError or ValueError for files that cannot be mapped, and OSError once the file
+    # changed since st was taken. Touching a mapped page past the end of a file truncated by
+    # another process kills the interpreter with SIGBUS, so the size and mtime are checked again
+    # before every chunk. That narrows the window to one chunk but cannot close it; a file cut
+    # short while that chunk is hashed still crashes, which is why mapping is opt-in.
+    size = st.st_size
+    with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+        if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        try:
+            for offset in range(0, size, MMAP_CHUNK_SIZE):
+                current = os.fstat(f.fileno())
+                if current.st_size < size or current.st_mtime_ns != st.st_mtime_ns:
+                    raise OSError(errno.EAGAIN, "File changed while it was being hashed", f.name)
+                hasher.update(view[offset:offset + MMAP_CHUNK_SIZE])
+        finally:
+            # The mapping cannot be closed while a view of it is alive
+            view.release()
+    return size
+
+def hash_buffered(f, hasher):
+    buf = get_read_buffer()
+    bytes_read = 0
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        hasher.update(buf[:n])
+        bytes_read += n
+    return bytes_read
+
+def hash_file(filepath, algorithm=DEFAULT_ALGORITHM, mmap_threshold=None):
+    # Large regular files are hashed from a memory mapping, everything else (small files, pipes
+    # and devices, filesystems without mmap support) through the reusable read buffer, as is a
+    # mapped file that changes while it is hashed. mmap_threshold=None, the default, always reads.
+    hasher = HASH_ALGORITHMS[algorithm]()
+    with open(filepath, "rb", buffering=0) as f:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        if stat.S_ISREG(st.st_mode):
+            advise_sequential(f.fileno(), size)
+            if mmap_threshold is not None and size and size >= mmap_threshold:
+                try:
+                    bytes_read = hash_mapped(f, st, hasher)
+                    return hasher.digest(), bytes_read
+                except (OSError, ValueError):
+                    hasher = HASH_ALGORITHMS[algorithm]()
+                    f.seek(0)
+        bytes_read = hash_buffered(f, hasher)
+    return hasher.digest(), bytes_read
+
+def read_digest(filepath, ranges=None, algorithm=DEFAULT_ALGORITHM, mmap_threshold=None):
+    # Worker entry point, must stay a module level function so process pools can pickle it.
+    # Returns (digest, bytes read, seconds spent reading and hashing).
+    start = time.perf_counter()
+    if ranges is None:
+        digest, bytes_read = hash_file(filepath, algorithm, mmap_threshold)
+    else:
+        digest, bytes_read = hash_ranges(filepath, ranges, algorithm)
+    return digest, bytes_read, time.perf_counter() - start
+
+class HashExecutor:
+    BACKENDS = ('thread', 'process')
+
+    def __init__(self, workers=None, backend='thread'):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown hashing backend: {backend}")
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.backend = backend
+        self.pool = None
+
+    def __enter__(self):
+        # A single worker hashes inline on the calling thread
+        if self.workers > 1:
+            pool_class = ThreadPoolExecutor if self.backend == 'thread' else ProcessPoolExecutor
+            self.pool = pool_class(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def submit(self, func, *args):
+        if self.pool is not None:
+            return self.pool.submit(func, *args)
+        future = Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def map(self, func, args_list):
+        # Yields (index, result, error) in completion order, keeping only a few tasks per worker in flight
+        if self.pool is None:
+            for index, args in enumerate(args_list):
+                try:
+                    yield index, func(*args), None
+                except Exception as e:
+                    yield index, None, e
+            return
+
+        pending = {}
+        args_iter = enumerate(args_list)
+        while True:
+            for index, args in args_iter:
+                pending[self.pool.submit(func, *args)] = index
+                if len(pending) >= self.workers * 4:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                error = future.exception()
+                yield index, None if error else future.result(), error
+
+class StagedHasher:
+    # Stages run in this order, each one only sees files that still collide after the previous one
+    STAGES = ('head', 'tail', 'middle', 'full')
+
+    def __init__(self, table, executor=None, head_size=64 * 1024, tail_size=64 * 1024,
+                 middle_samples=2, middle_size=64 * 1024, keep_group=None, store_hash=None,
+                 algorithm=DEFAULT_ALGORITHM, mmap_threshold=None, telemetry=None, cancel=None, log=print,
+                 error_log=None):
+        self.table = table
+        self.telemetry = telemetry
+        self.log = log
+        # Where unreadable files are reported, log unless given; never stdout in the CLI, which
+        # prints results there
+        self.error_log = error_log or log
+        # threading.Event; once set, the running stage stops with ScanCancelled
+        self.cancel = cancel
+        self.executor = executor or HashExecutor(workers=1)
+        self.algorithm = algorithm
+        # Size from which whole files are read through a memory mapping, None never maps
+        self.mmap_threshold = mmap_threshold
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self.middle_samples = middle_samples
+        self.middle_size = middle_size
+        self.keep_group = keep_group or (lambda group: len(group) > 1)
+        self.store_hash = store_hash
+        self.stats = {stage: {'files': 0, 'bytes': 0} for stage in self.STAGES}
+        self.elapsed = 0.0
+        self.started = None
+        self.prefetching = deque()
+        self.prefetched = {}
+
+    def sample_ranges(self, stage, size):
+        if stage == 'head':
+            return [(0, min(self.head_size, size))]
+        if stage == 'tail':
+            start = max(self.head_size, size - self.tail_size)
+            return [(start, size - start)] if size > start else []
+        # Evenly spaced blocks between the end of the head and the start of the tail
+        span_start = self.head_size
+        span_end = size - self.tail_size
+        if self.middle_samples <= 0 or span_end - span_start <= self.middle_samples * self.middle_size:
+            return []
+        free_space = span_end - span_start - self.middle_size
+        return [(span_start + free_space * (i + 1) // (self.middle_samples + 1), self.middle_size)
+                for i in range(self.middle_samples)]
+
+    def prefetch(self, file_id):
+        # Start reading the head block of a candidate while the directory walk is still running
+        if self.started is None:
+            self.started = time.perf_counter()
+        ranges = self.sample_ranges('head', self.table.sizes[file_id])
+        future = self.executor.submit(read_digest, self.table.path(file_id), ranges, self.algorithm,
+                                      self.mmap_threshold)
+        self.prefetching.append((file_id, ranges, future))
+        # Keep only a few reads per worker in flight, the walk waits for the oldest one beyond that
+        while len(self.prefetching) > self.executor.workers * 4:
+            self.collect_prefetched()
+
+    def collect_prefetched(self):
+        file_id, ranges, future = self.prefetching.popleft()
+        error = future.exception()
+        self.prefetched[file_id] = (ranges, None if error else future.result(), error)
+
+    def stage_results(self, stage, jobs):
+        # Head blocks read during the walk are used as they are, everything else goes to the executor
+        while self.prefetching:
+            self.collect_prefetched()
+        pending = []
+        for index, (file_id, ranges) in enumerate(jobs):
+            prefetched = self.prefetched.pop(file_id, None) if stage == 'head' else None
+            if prefetched is not None and prefetched[0] == ranges:
+                yield index, prefetched[1], prefetched[2]
+            else:
+                pending.append(index)
+        results = self.executor.map(read_digest, [(self.table.path(jobs[i][0]), jobs[i][1], self.algorithm,
+                                                   self.mmap_threshold) for i in pending])
+        for index, result, error in results:
+            yield pending[index], result, error
+
+    def run_stage(self, stage, groups, progress=None):
+        # Groups where every file already has its full digest (cached, or read whole by
+        # the head stage) are split on it directly. In a group where only some files have it,
+        # those can only be compared by full digest, so the partial stages pass it on untouched
+        # and the full stage reads just the files still missing one.
+        table = self.table
+        resolved = []
+        mixed = []
+        jobs = []
+        for group in groups:
+            digested = sum(1 for i in group if table.has_digest(i))
+            resolved.append(digested == len(group))
+            mixed.append(0 < digested < len(group))
+            if digested == len(group) or (digested and stage != 'full'):
+                continue
+            for file_id in group:
+                if stage == 'full':
+                    if not table.has_digest(file_id):
+                        jobs.append((file_id, None))
+                else:
+                    ranges = self.sample_ranges(stage, table.sizes[file_id])
+                    if ranges:
+                        jobs.append((file_id, ranges))
+
+        stats = self.stats[stage]
+        keys = {}
+        for processed, (index, result, error) in enumerate(self.stage_results(stage, jobs), 1):
+            check_cancelled(self.cancel)
+            file_id, ranges = jobs[index]
+            if error is not None:
+                self.error_log(f"Error processing {table.path(file_id)}: {str(error)}")
+                if self.telemetry is not None:
+                    self.telemetry.file_error(stage, table.path(file_id), error)
+                keys[file_id] = error
+                if progress:
+                    progress(stage, processed, len(jobs), file_id, 0)
+                continue
+            digest, bytes_read, seconds = result
+            if self.telemetry is not None:
+                self.telemetry.file_read(stage, table.path(file_id), seconds, bytes_read)
+            if progress:
+                progress(stage, processed, len(jobs), file_id, bytes_read)
+            stats['files'] += 1
+            stats['bytes'] += bytes_read
+            keys[file_id] = digest
+            # The full stage, or a head block that covered the whole file, gives the full-content digest
+            if ranges is None or (stage == 'head' and table.sizes[file_id] <= self.head_size):
+                table.set_digest(file_id, digest)
+                if self.store_hash:
+                    self.store_hash(file_id)
+
+        refined = []
+        for group, group_resolved, group_mixed in zip(groups, resolved, mixed):
+            if group_mixed and stage != 'full':
+                refined.append(group)
+                continue
+            buckets = {}
+            for file_id in group:
+                if group_resolved or stage == 'full':
+                    key = table.digest(file_id)
+                else:
+                    key = keys.get(file_id)
+                if isinstance(key, Exception) or (stage == 'full' and key is None):
+                    continue
+                if key in buckets:
+                    buckets[key].append(file_id)
+                else:
+                    buckets[key] = [file_id]
+            refined.extend(bucket for bucket in buckets.values() if self.keep_group(bucket))
+        return refined
+
+    def find_duplicates(self, groups, progress=None):
+        # Each group holds ids of files with the same size, the result holds ids with the same full digest
+        start = self.started or time.perf_counter()
+        groups = [group for group in groups if self.keep_group(group)]
+        for stage in self.STAGES:
+            if self.telemetry is None:
+                groups = self.run_stage(stage, groups, progress)
+                continue
+            # Head blocks prefetched during the walk count towards the head stage's files and
+            # bytes, but their time towards the walk
+            with self.telemetry.stage(stage):
+                groups = self.run_stage(stage, groups, progress)
+        self.elapsed += time.perf_counter() - start
+        self.started = None
+        return groups
+
+    def format_stats(self):
+        return ", ".join(f"{stage}: {stats['files']} files / {format_size(stats['bytes'])}"
+                         for stage, stats in self.stats.items())
+
+    def format_throughput(self):
+        files = sum(stats['files'] for stats in self.stats.values())
+        total_bytes = sum(stats['bytes'] for stats in self.stats.values())
+        elapsed = self.elapsed or 1e-9
+        return (f"{files / elapsed:.1f} files/s, {total_bytes / elapsed / (1024 * 1024):.1f} MB/s "
+                f"({self.algorithm}, {self.executor.workers} {self.executor.backend} workers)")
+
+def get_file_hash(filepath, algorithm=DEFAULT_ALGORITHM, hash_cache=None, st=None, telemetry=None):
+    # Hex digest of one file's full content, served from the hash cache while the file is unchanged
+    if hash_cache is not None:
+        if hash_cache.algorithm != algorithm:
+            raise ValueError(f"Hash cache holds {hash_cache.algorithm} digests, not {algorithm}")
+        key = stat_key(st or os.stat(filepath))
+        digest = hash_cache.get(filepath, key)
+        if telemetry is not None:
+            telemetry.cache_lookups(int(digest is not None), int(digest is None))
+        if digest is not None:
+            return digest.hex()
+
+    digest, bytes_read, seconds = read_digest(filepath, None, algorithm)
+    if telemetry is not None:
+        telemetry.file_read('full', filepath, seconds, bytes_read)
+    if hash_cache is not None:
+        hash_cache.put(filepath, key, digest)
+    return digest.hex()
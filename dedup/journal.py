@@ -0,0 +1,214 @@
+import json
+import os
+import time
+import uuid
+
+from .utils import get_config_dir
+
+JOURNAL_VERSION = 1
+
+def journal_dir():
+    return os.path.join(get_config_dir(), 'journals')
+
+def new_run_id():
+    # Sorts by start time, unique even for runs started within the same second
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+class ActionJournal:
+    # Append-only record of one bulk action, one JSON object per line: a header naming the action
+    # and quarantine folder, every planned (path, keep path, stat key) job, then one line per job
+    # as it is done or fails, and per quarantined file moved back by a rollback.
+    # Lines are only ever appended and synced after every batch, so after a crash the journal
+    # tells which jobs still have to run (resume) and where quarantined files went (rollback).
+    # A torn last line is ignored when the journal is read back.
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.jobs = []
+        self.outcomes = {}  # Job index -> (bytes freed, error message or None), last record wins
+        self.restored = set()
+        self.ended = False
+        self.file = None
+
+    @classmethod
+    def create(cls, action, jobs, quarantine=None, path=None, run_id=None):
+        run_id = run_id or new_run_id()
+        journal = cls(path or os.path.join(journal_dir(), f"{run_id}.jsonl"))
+        os.makedirs(os.path.dirname(os.path.abspath(journal.path)), exist_ok=True)
+        journal.file = open(journal.path, 'x', encoding='utf-8')
+        journal.header = {'version': JOURNAL_VERSION, 'run': run_id, 'action': action,
+                          'quarantine': quarantine, 'started': time.time()}
+        journal.write({'type': 'begin', **journal.header})
+        journal.add_jobs(jobs)
+        return journal
+
+    @classmethod
+    def open(cls, path):
+        journal = cls(path)
+        # Bytes up to the end of the last record that is kept
+        complete = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    if line.endswith(b'\n'):
+                        complete += len(line)
+                    continue
+                complete += len(line)
+                journal.replay(record)
+            size = f.tell()
+            ends_line = line.endswith(b'\n') if size else True
+        if journal.header is None:
+            raise ValueError(f"Not an action journal: {path}")
+        if journal.header.get('version') != JOURNAL_VERSION:
+            raise ValueError(f"Unsupported journal version {journal.header.get('version')}: {path}")
+        # A last line torn by a crash is cut off, and a last record missing only its newline gets
+        # one, so records appended from here on start on a line of their own
+        if complete < size:
+            os.truncate(path, complete)
+        journal.file = open(path, 'a', encoding='utf-8')
+        if complete == size and not ends_line:
+            journal.file.write("\n")
+        return journal
+
+    def replay(self, record):
+        kind = record.get('type')
+        # A run is settled while its last record is an 'end'; jobs added or retried after one reopen it
+        self.ended = kind == 'end'
+        if kind == 'begin':
+            self.header = {key: value for key, value in record.items() if key != 'type'}
+        elif kind == 'job':
+            key = record['key']
+            self.jobs.append((record['path'], record['keep'], tuple(key) if key is not None else None))
+        elif kind == 'done':
+            self.outcomes[record['job']] = (record['freed'], None)
+            self.restored.discard(record['job'])
+        elif kind == 'error':
+            self.outcomes[record['job']] = (0, record['message'])
+        elif kind == 'restored':
+            self.restored.add(record['job'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def action(self):
+        return self.header['action']
+
+    @property
+    def quarantine(self):
+        return self.header['quarantine']
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + "\n")
+        self.ended = record['type'] == 'end'
+
+    def add_jobs(self, jobs):
+        # Appends (path, keep path, stat key) jobs, also to a run that already went through its
+        # earlier ones, e.g. files quarantined one at a time; returns their job indices
+        start = len(self.jobs)
+        for index, (filepath, keep_path, expected_key) in enumerate(jobs, start):
+            self.write({'type': 'job', 'job': index, 'path': filepath, 'keep': keep_path,
+                        'key': list(expected_key) if expected_key is not None else None})
+        self.jobs.extend(jobs)
+        self.sync()
+        return list(range(start, len(self.jobs)))
+
+    def sync(self):
+        # Flushed and synced once per batch: losing a batch in a crash only means resume looks
+        # at those files again
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record(self, indices, results):
+        # Outcome of one batch of jobs; None results are jobs that were not run
+        for index, result in zip(indices, results):
+            if result is None:
+                continue
+            freed, error = result
+            self.outcomes[index] = result
+            if error is None:
+                self.restored.discard(index)
+                self.write({'type': 'done', 'job': index, 'freed': freed})
+            else:
+                self.write({'type': 'error', 'job': index, 'message': error})
+        self.sync()
+
+    def record_restored(self, indices):
+        for index in indices:
+            self.restored.add(index)
+            self.write({'type': 'restored', 'job': index})
+        self.sync()
+
+    def finish(self):
+        # A run is settled once every job has run, failed ones included: their errors were
+        # reported as they happened, and a file that keeps failing (changed since the scan, no
+        # reflink support) would otherwise leave the run to be resumed forever. Retrying them
+        # takes resuming this journal explicitly.
+        if not self.ended and len(self.outcomes) == len(self.jobs):
+            failed = len(self.pending())
+            if failed:
+                self.end(failed=failed)
+            else:
+                self.end()
+
+    def end(self, **fields):
+        # Marks the run as settled, whether all its jobs are done, it was rolled back or abandoned
+        self.write({'type': 'end', 'finished': time.time(), **fields})
+        self.sync()
+
+    def abandon(self):
+        # Settles a run that was cut off without running its remaining jobs
+        self.end(abandoned=len(self.pending()))
+
+    def pending(self):
+        # Jobs without a successful outcome: never run, cut off by a crash or cancel, or failed
+        return [index for index in range(len(self.jobs))
+                if index not in self.outcomes or self.outcomes[index][1] is not None]
+
+    def done(self):
+        return [index for index, (freed, error) in self.outcomes.items() if error is None]
+
+    def summary(self):
+        errors = sum(1 for freed, error in self.outcomes.values() if error is not None)
+        done = len(self.outcomes) - errors
+        return {'run': self.header['run'], 'action': self.action, 'jobs': len(self.jobs), 'done': done,
+                'errors': errors, 'pending': len(self.jobs) - done, 'restored': len(self.restored),
+                'freed': sum(freed for freed, error in self.outcomes.values() if error is None)}
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def is_finished(path):
+    # Only reads the last line, the 'end' record a finished run closes its journal with
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - 4096))
+        lines = f.read().splitlines()
+    try:
+        return bool(lines) and json.loads(lines[-1]).get('type') == 'end'
+    except ValueError:
+        return False
+
+def unfinished_journals(directory=None):
+    # Journals of runs that stopped before every job was done, newest first
+    directory = directory or journal_dir()
+    try:
+        names = sorted((name for name in os.listdir(directory) if name.endswith('.jsonl')), reverse=True)
+    except FileNotFoundError:
+        return []
+    unfinished = []
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            if not is_finished(path):
+                unfinished.append(path)
+        except OSError:
+            continue
+    return unfinished
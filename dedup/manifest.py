@@ -0,0 +1,132 @@
+import os
+import sqlite3
+import threading
+import time
+
+from .utils import get_config_dir
+
+# Directory mtimes this close to the previous scan are not trusted: an entry added in the same
+# timestamp tick as that scan would not have changed the mtime it recorded
+RACY_WINDOW_NS = 2 * 10**9
+
+class PreviousScan:
+    # What the manifest knew about one scanned root, plus the counters of the scan reusing it
+    def __init__(self, root, scanned_at_ns=0):
+        self.root = root
+        self.scanned_at_ns = scanned_at_ns
+        self.mtimes = {}
+        self.subdirs = {}
+        self.files = {}  # directory -> {name: (stat key, digest or None)}
+        self.dir_mtimes = {}
+        self.dirs_skipped = 0
+        self.dirs_listed = 0
+        self.files_added = 0
+        self.files_modified = 0
+
+    def is_unchanged(self, directory, mtime_ns):
+        known = self.mtimes.get(directory)
+        return known == mtime_ns and mtime_ns < self.scanned_at_ns - RACY_WINDOW_NS
+
+    def file_count(self):
+        return sum(len(files) for files in self.files.values())
+
+    def format_stats(self, files_seen):
+        # Files that were neither seen again nor replaced are gone
+        removed = max(0, self.file_count() - (files_seen - self.files_added))
+        return (f"{self.root}: {self.dirs_skipped} folders unchanged, {self.dirs_listed} listed, "
+                f"{self.files_added} new, {self.files_modified} modified, {removed} removed files")
+
+class ScanManifest:
+    # The file list of every scanned root: directory mtimes, per file the stat key and the digest
+    # found by the last scan, so the next scan only lists changed directories and only hashes
+    # changed files. Rows are keyed by root as well: a folder scanned both as a root and as part
+    # of an enclosing root has one copy per root, so saving either never touches the other.
+    SCHEMA_VERSION = 3
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = os.path.join(get_config_dir(), 'scan_manifest.sqlite3')
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            for table in ('roots', 'dirs', 'files'):
+                self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+            self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS roots ("
+            "root TEXT PRIMARY KEY, walk TEXT, algorithm TEXT, scanned_at_ns INTEGER)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dirs (root TEXT, path TEXT, mtime_ns INTEGER, PRIMARY KEY (root, path))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "root TEXT, dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+            "device INTEGER, digest BLOB, PRIMARY KEY (root, dir, name))"
+        )
+        self.conn.commit()
+
+    def load(self, root, walk, algorithm):
+        # Digests are only reused by scans with the same algorithm, the file list by any scan
+        # that walks the same way (walk is scanner.WalkOptions.signature())
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT walk, algorithm, scanned_at_ns FROM roots WHERE root = ?", (root,)
+            ).fetchone()
+            if row is None or row[0] != walk:
+                return PreviousScan(root)
+            previous = PreviousScan(root, row[2])
+            same_algorithm = row[1] == algorithm
+            for path, mtime_ns in self.conn.execute("SELECT path, mtime_ns FROM dirs WHERE root = ?", (root,)):
+                previous.mtimes[path] = mtime_ns
+                if path != root:
+                    previous.subdirs.setdefault(os.path.dirname(path), []).append(path)
+            rows = self.conn.execute(
+                "SELECT dir, name, size, mtime_ns, inode, device, digest FROM files WHERE root = ?", (root,)
+            )
+            for directory, name, size, mtime_ns, inode, device, digest in rows:
+                files = previous.files.get(directory)
+                if files is None:
+                    files = previous.files[directory] = {}
+                files[name] = ((size, mtime_ns, inode, device), digest if same_algorithm else None)
+        return previous
+
+    def save(self, root, walk, algorithm, table, file_ids, dir_mtimes, scanned_at_ns=None):
+        # Replaces everything stored for root with the given scan
+        if scanned_at_ns is None:
+            scanned_at_ns = time.time_ns()
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE root = ?", (root,))
+            self.conn.execute("DELETE FROM dirs WHERE root = ?", (root,))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO roots (root, walk, algorithm, scanned_at_ns) VALUES (?, ?, ?, ?)",
+                (root, walk, algorithm, scanned_at_ns)
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO dirs (root, path, mtime_ns) VALUES (?, ?, ?)",
+                ((root, path, mtime_ns) for path, mtime_ns in dir_mtimes.items())
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (root, dir, name, size, mtime_ns, inode, device, digest) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((root, table.directory(i), table.name(i), *table.stat_key(i), table.digest(i)) for i in file_ids)
+            )
+            self.conn.commit()
+
+    def forget(self, root=None):
+        # Drops one root, or everything
+        with self.lock:
+            if root is None:
+                for table in ('roots', 'dirs', 'files'):
+                    self.conn.execute(f"DELETE FROM {table}")
+            else:
+                for table, column in (('roots', 'root'), ('dirs', 'root'), ('files', 'root')):
+                    self.conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (root,))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
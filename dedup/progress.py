@@ -0,0 +1,79 @@
+import threading
+import time
+
+class ScanCancelled(Exception):
+    # Raised on the scanning thread once its cancel event is set
+    pass
+
+def check_cancelled(cancel):
+    # Cheap enough to call per file: Event.is_set only reads a flag
+    if cancel is not None and cancel.is_set():
+        raise ScanCancelled()
+
+class ProgressTracker:
+    # Counters shared between the scanning thread, the hashing workers and whatever displays them.
+    # Writers only bump numbers under a lock; the display polls snapshot() at its own pace.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.current = 0
+            self.total = 0
+            self.status = ""
+            self.files_done = 0
+            self.bytes_done = 0
+            self.started = time.perf_counter()
+            self.step_started = self.started
+            self.finished = False
+
+    def __call__(self, current, total, status_text):
+        self.update(current, total, status_text)
+
+    def update(self, current, total, status_text):
+        with self.lock:
+            if current < self.current:
+                # The counter went back, so a new step (directory or hashing stage) started
+                self.step_started = time.perf_counter()
+            self.current = current
+            self.total = total
+            self.status = status_text
+
+    def add(self, files=0, bytes_read=0):
+        with self.lock:
+            self.files_done += files
+            self.bytes_done += bytes_read
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+
+    def snapshot(self):
+        with self.lock:
+            now = time.perf_counter()
+            elapsed = max(now - self.started, 1e-9)
+            eta = None
+            if self.total and self.current:
+                eta = (now - self.step_started) * (self.total - self.current) / self.current
+            return {
+                'current': self.current,
+                'total': self.total,
+                'percent': (self.current / self.total * 100) if self.total > 0 else 0,
+                'status': self.status,
+                'files_per_sec': self.files_done / elapsed,
+                'mb_per_sec': self.bytes_done / elapsed / (1024 * 1024),
+                'eta': eta,
+                'finished': self.finished
+            }
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+def format_progress(snapshot):
+    rates = f"{snapshot['files_per_sec']:.1f} files/s, {snapshot['mb_per_sec']:.1f} MB/s"
+    if snapshot['eta'] is not None:
+        rates += f", ETA {format_duration(snapshot['eta'])}"
+    return f"{snapshot['status']}  ({rates})"
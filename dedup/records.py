@@ -0,0 +1,91 @@
+import os
+from array import array
+
+# Inode and device numbers are truncated to 63 bits, ReFS can report wider ones and
+# SQLite only stores signed 64-bit integers
+INODE_MASK = (1 << 63) - 1
+
+def stat_key(st):
+    # The part of a stat result that tells whether a file changed since it was hashed
+    return (st.st_size, st.st_mtime_ns, st.st_ino & INODE_MASK, st.st_dev & INODE_MASK)
+
+class FileTable:
+    # Columnar store of scanned files, addressed by integer file ids.
+    # Each directory path is stored once, names are packed into one buffer, numeric
+    # fields live in typed arrays and digests are raw bytes in a fixed-width column.
+    def __init__(self):
+        self.dirs = []
+        self.dir_ids = {}
+        self.dir_index = array('I')
+        self.name_data = bytearray()
+        self.name_offsets = array('Q', [0])
+        self.sizes = array('q')
+        self.ctimes = array('d')
+        self.mtimes = array('q')
+        self.inodes = array('Q')
+        self.devices = array('Q')
+        self.nlinks = array('I')
+        self.sides = array('B')
+        self.digest_size = None
+        self.digest_data = bytearray()
+        self.digest_set = bytearray()
+        # Off for files reached through another machine or mount than the one that scanned them,
+        # whose inode and device numbers differ
+        self.check_inodes = True
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def add(self, directory, name, st, side=0):
+        dir_id = self.dir_ids.get(directory)
+        if dir_id is None:
+            dir_id = self.dir_ids[directory] = len(self.dirs)
+            self.dirs.append(directory)
+        self.dir_index.append(dir_id)
+        self.name_data += os.fsencode(name)
+        self.name_offsets.append(len(self.name_data))
+        self.sizes.append(st.st_size)
+        self.ctimes.append(st.st_ctime)
+        self.mtimes.append(st.st_mtime_ns)
+        self.inodes.append(st.st_ino & INODE_MASK)
+        self.devices.append(st.st_dev & INODE_MASK)
+        self.nlinks.append(st.st_nlink)
+        self.sides.append(side)
+        self.digest_set.append(0)
+        return len(self.sizes) - 1
+
+    def name(self, file_id):
+        return os.fsdecode(bytes(self.name_data[self.name_offsets[file_id]:self.name_offsets[file_id + 1]]))
+
+    def directory(self, file_id):
+        return self.dirs[self.dir_index[file_id]]
+
+    def path(self, file_id):
+        return os.path.join(self.dirs[self.dir_index[file_id]], self.name(file_id))
+
+    def stat_key(self, file_id):
+        # None fields are not compared, see replace_file
+        if not self.check_inodes:
+            return (self.sizes[file_id], self.mtimes[file_id], None, None)
+        return (self.sizes[file_id], self.mtimes[file_id], self.inodes[file_id], self.devices[file_id])
+
+    def has_digest(self, file_id):
+        return self.digest_set[file_id] == 1
+
+    def digest(self, file_id):
+        if not self.digest_set[file_id]:
+            return None
+        start = file_id * self.digest_size
+        return bytes(self.digest_data[start:start + self.digest_size])
+
+    def set_digest(self, file_id, digest):
+        if self.digest_size is None:
+            self.digest_size = len(digest)
+        elif len(digest) != self.digest_size:
+            raise ValueError(f"Digest of {len(digest)} bytes in a table of {self.digest_size} byte digests")
+        end = (file_id + 1) * self.digest_size
+        if len(self.digest_data) < end:
+            # The digest column only grows as far as the highest hashed file id
+            self.digest_data.extend(bytes(max(end, len(self.sizes) * self.digest_size) - len(self.digest_data)))
+        self.digest_data[end - self.digest_size:end] = digest
+        self.digest_set[file_id] = 1
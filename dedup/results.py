@@ -0,0 +1,220 @@
+import gc
+import json
+import mmap
+import os
+import platform
+import sys
+import time
+from array import array
+from itertools import repeat
+
+from .groups import DuplicateGroup, DuplicateIndex
+from .records import FileTable
+
+# Scan results in one file: a JSON header, then every column of the file table and of the
+# duplicate groups as a packed little- or big-endian array, as written by the scanning machine.
+# Opening a result maps the file and views the columns in place, so nothing is read until it
+# is used; only the folder paths and the group objects are built up front.
+RESULTS_MAGIC = b'DEDUPRS1'
+RESULTS_VERSION = 1
+# Numeric columns start at a multiple of this
+COLUMN_ALIGNMENT = 8
+# The name and digest buffers get mappings of their own, whose offsets have to be a multiple
+# of the allocation granularity; 64 KiB is the largest one in use (Windows)
+BUFFER_ALIGNMENT = 65536
+
+# (section, typecode) of the file table columns, in file order
+TABLE_COLUMNS = (
+    ('dir_index', 'I'), ('name_offsets', 'Q'), ('sizes', 'q'), ('ctimes', 'd'), ('mtimes', 'q'),
+    ('inodes', 'Q'), ('devices', 'Q'), ('nlinks', 'I'), ('sides', 'B'), ('digest_set', 'B'),
+)
+# Sections read as plain bytes through a mapping of their own
+TABLE_BUFFERS = ('name_data', 'digest_data')
+
+class ResultsError(ValueError):
+    pass
+
+def group_columns(duplicates):
+    # The groups as flat columns: members of group n are group_members[group_offsets[n]:group_offsets[n + 1]]
+    columns = {
+        'group_ids': array('q'), 'group_keeps': array('q'), 'group_digests': array('B'),
+        'group_offsets': array('Q', [0]), 'group_members': array('q'),
+        'link_names': array('q'), 'link_firsts': array('q'),
+    }
+    table = duplicates.table
+    for group in duplicates:
+        columns['group_ids'].append(group.group_id)
+        columns['group_keeps'].append(group.keep)
+        columns['group_digests'].append(group.digest is not None)
+        columns['group_members'].extend(group.members)
+        columns['group_offsets'].append(len(columns['group_members']))
+    for first, names in duplicates.linked_names.items():
+        for name in names:
+            columns['link_names'].append(name)
+            columns['link_firsts'].append(first)
+    dir_data = bytearray()
+    dir_offsets = array('Q', [0])
+    for directory in table.dirs:
+        dir_data += os.fsencode(directory)
+        dir_offsets.append(len(dir_data))
+    columns['dir_data'] = dir_data
+    columns['dir_offsets'] = dir_offsets
+    return columns
+
+def save_results(path, duplicates, stats=None):
+    # Writes the file table and groups of duplicates to path, replacing it atomically
+    table = duplicates.table
+    sections = [(name, getattr(table, name)) for name, typecode in TABLE_COLUMNS]
+    sections += [(name, getattr(table, name)) for name in TABLE_BUFFERS]
+    sections += list(group_columns(duplicates).items())
+    # Section offsets count from the start of the data, which follows the header, so they are
+    # known before the header that holds them is
+    layout = {}
+    offset = 0
+    for name, data in sections:
+        alignment = BUFFER_ALIGNMENT if name in TABLE_BUFFERS else COLUMN_ALIGNMENT
+        offset = -(-offset // alignment) * alignment
+        length = memoryview(data).nbytes
+        layout[name] = [offset, length]
+        offset += length
+    header = {
+        'version': RESULTS_VERSION,
+        'byteorder': sys.byteorder,
+        'created': time.time(),
+        'host': platform.node(),
+        'algorithm': duplicates.algorithm,
+        'keep_policy': duplicates.keep_policy,
+        'roots': duplicates.roots,
+        'root_paths': duplicates.root_paths,
+        'priority': duplicates.priority,
+        'files': len(table),
+        'groups': len(duplicates),
+        'digest_size': table.digest_size,
+        'stats': stats,
+        'sections': layout,
+    }
+    header_bytes = json.dumps(header).encode()
+    # The data starts on a buffer boundary, so the section offsets stay aligned in the file
+    data_start = -(-(len(RESULTS_MAGIC) + 8 + len(header_bytes)) // BUFFER_ALIGNMENT) * BUFFER_ALIGNMENT
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(RESULTS_MAGIC)
+        f.write(data_start.to_bytes(8, 'little'))
+        f.write(header_bytes)
+        for name, data in sections:
+            f.seek(data_start + layout[name][0])
+            f.write(memoryview(data).cast('B'))
+        # A trailing empty section still needs the file to reach its offset
+        f.truncate(data_start + offset)
+    os.replace(tmp, path)
+
+def read_header(f):
+    if f.read(len(RESULTS_MAGIC)) != RESULTS_MAGIC:
+        raise ResultsError("Not a saved scan result")
+    data_start = int.from_bytes(f.read(8), 'little')
+    try:
+        header = json.loads(f.read(data_start - len(RESULTS_MAGIC) - 8).rstrip(b'\0'))
+    except ValueError as e:
+        raise ResultsError(f"Damaged scan result header: {str(e)}") from e
+    if header.get('version') != RESULTS_VERSION:
+        raise ResultsError(f"Unsupported scan result version: {header.get('version')}")
+    header['data_start'] = data_start
+    return header
+
+def results_header(path):
+    # Only the header, e.g. to find out which roots a result needs before opening it
+    with open(path, 'rb') as f:
+        return read_header(f)
+
+def map_results(path):
+    # (header, mapping of the whole file); the mapping is read-only and shared with the page cache
+    with open(path, 'rb') as f:
+        header = read_header(f)
+        size = os.fstat(f.fileno()).st_size
+        end = max(start + length for start, length in header['sections'].values()) + header['data_start']
+        if size < end:
+            raise ResultsError(f"Scan result is truncated: {size} of {end} bytes")
+        return header, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), f.name
+
+def remap(directory, root_map):
+    # Rewrites a path below an old root to the same place below its new location
+    for old, new in root_map:
+        if directory == old or directory.startswith(os.path.join(old, '')):
+            return new + directory[len(old):]
+    return directory
+
+def load_results(path, root_map=None):
+    # Opens a saved result as a DuplicateIndex whose table columns are views of the file.
+    # root_map maps root paths of the scanning machine to where they are mounted here. Inode and
+    # device numbers from another machine or mount mean nothing here, so results opened that
+    # way only check size and modification time before acting on a file.
+    header, mapping, name = map_results(path)
+    data_start = header['data_start']
+    sections = header['sections']
+    swap = header['byteorder'] != sys.byteorder
+
+    def column(section, typecode):
+        start, length = sections[section]
+        view = memoryview(mapping)[data_start + start:data_start + start + length]
+        if not swap and typecode != 'B':
+            return view.cast(typecode)
+        if not swap:
+            return view
+        values = array(typecode)
+        values.frombytes(view)
+        values.byteswap()
+        return values
+
+    def buffer(section):
+        start, length = sections[section]
+        if not length:
+            return b''
+        with open(name, 'rb') as f:
+            return mmap.mmap(f.fileno(), length, offset=data_start + start, access=mmap.ACCESS_READ)
+
+    table = FileTable()
+    for section, typecode in TABLE_COLUMNS:
+        setattr(table, section, column(section, typecode))
+    table.name_data = buffer('name_data')
+    table.digest_data = buffer('digest_data')
+    table.digest_size = header['digest_size']
+
+    root_map = [(os.path.normpath(old), os.path.normpath(new)) for old, new in (root_map or {}).items()]
+    dir_data = column('dir_data', 'B')
+    dir_offsets = column('dir_offsets', 'Q')
+    table.dirs = [remap(os.fsdecode(bytes(dir_data[dir_offsets[i]:dir_offsets[i + 1]])), root_map)
+                  for i in range(len(dir_offsets) - 1)]
+    table.dir_ids = {directory: dir_id for dir_id, directory in enumerate(table.dirs)}
+    if root_map or header['host'] != platform.node():
+        table.check_inodes = False
+
+    links = dict(zip(column('link_names', 'q'), column('link_firsts', 'q')))
+    duplicates = DuplicateIndex(table, header['algorithm'], header['keep_policy'], header['roots'], links,
+                                header['priority'], [remap(root, root_map) for root in header['root_paths']])
+    # One pass over plain lists, the groups are the only part of a result built up front. They
+    # hold no reference cycles, so the collector is paused instead of rescanning them while
+    # hundreds of thousands are allocated.
+    group_ids = column('group_ids', 'q').tolist()
+    keeps = column('group_keeps', 'q').tolist()
+    has_digest = column('group_digests', 'B').tolist()
+    offsets = column('group_offsets', 'Q').tolist()
+    members = column('group_members', 'q').tolist()
+    sizes, digest_data, digest_size = table.sizes, table.digest_data, table.digest_size
+    groups = duplicates.groups
+    member_groups = []
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        for n, group_id in enumerate(group_ids):
+            start, end = offsets[n], offsets[n + 1]
+            first = members[start]
+            digest = digest_data[first * digest_size:(first + 1) * digest_size] if has_digest[n] else None
+            group = groups[group_id] = DuplicateGroup(group_id, digest, sizes[first], members[start:end])
+            group.keep = keeps[n]
+            member_groups.extend(repeat(group_id, end - start))
+        duplicates.file_groups = dict(zip(members, member_groups))
+    finally:
+        if collecting:
+            gc.enable()
+    duplicates.next_group_id = max(group_ids, default=-1) + 1
+    return duplicates, header
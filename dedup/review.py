@@ -0,0 +1,177 @@
+import operator
+import os
+from array import array
+
+from .similar import PERCEPTUAL_HASHES
+
+# Columns the results table can be sorted by
+SORT_KEYS = ('reclaimable', 'count', 'size', 'extension', 'directory')
+
+class GroupTable:
+    # One row per duplicate group of a DuplicateIndex, for a results table that only ever shows a
+    # window of rows. The values rows are sorted and filtered by are kept in typed columns, text
+    # values as ranks into their sorted distinct values, so a sort order is one sort of integers.
+    # Text columns are only built once something sorts or filters by them, and each order is
+    # computed once and reused until the rows change. The totals of the remaining groups are
+    # kept up to date by update(), so a summary never has to walk the groups again.
+    def __init__(self, duplicates):
+        self.duplicates = duplicates
+        self.rebuild()
+
+    def __len__(self):
+        return len(self.group_ids)
+
+    def rebuild(self):
+        duplicates = self.duplicates
+        table = duplicates.table
+        groups = list(duplicates)
+        # Each column is filled by one array constructor rather than an append per group
+        self.group_ids = array('q', duplicates.groups)
+        self.keep_ids = array('q', (group.keep for group in groups))
+        counts = array('q', (len(group.members) for group in groups))
+        sizes = array('q', (group.size for group in groups))
+        # Files per row that cleaning up the group removes, for the totals only. In one root
+        # without hard links every copy but the kept one goes and frees the group's size.
+        self.redundant = redundant = array('q', (count - 1 for count in counts))
+        reclaimable = array('q', map(operator.mul, sizes, redundant))
+        # Near-duplicate groups mix file sizes, the other cases are rare enough to sum up per group
+        if (duplicates.roots > 1 or duplicates.linked_names or max(table.nlinks, default=1) > 1
+                or duplicates.algorithm in PERCEPTUAL_HASHES):
+            for row, group in enumerate(groups):
+                reclaimable[row] = duplicates.reclaimable_bytes(group)
+                redundant[row] = len(duplicates.redundant(group))
+        self.columns = {'reclaimable': reclaimable, 'count': counts, 'size': sizes}
+        self.extension_names = []
+        self.extension_ids = {}
+        self.extension_index = None
+        self.rows = dict(zip(self.group_ids, range(len(groups))))
+        self.orders = {}
+        self.redundant_total = sum(redundant)
+        self.reclaimable_total = sum(reclaimable)
+
+    def column(self, key):
+        if key not in self.columns:
+            if key == 'extension':
+                self.columns[key] = self.ranked(self.extensions_of_rows(), self.extension_names)
+            elif key == 'directory':
+                dir_index = self.duplicates.table.dir_index
+                self.columns[key] = self.ranked(array('I', (dir_index[keep] for keep in self.keep_ids)),
+                                                self.duplicates.table.dirs)
+            else:
+                raise ValueError(f"Unknown sort key: {key}")
+        return self.columns[key]
+
+    def extensions_of_rows(self):
+        # Extension id of each row's kept file, read from the packed names without decoding them
+        if self.extension_index is None:
+            table = self.duplicates.table
+            name_data, name_offsets = table.name_data, table.name_offsets
+            raw_extension_ids = {}
+            self.extension_index = array('I')
+            for keep in self.keep_ids:
+                start, end = name_offsets[keep], name_offsets[keep + 1]
+                dot = name_data.rfind(b'.', start, end)
+                extension = bytes(name_data[dot:end]).lower() if dot > start else b''
+                extension_id = raw_extension_ids.get(extension)
+                if extension_id is None:
+                    extension_id = raw_extension_ids[extension] = self.add_extension(os.fsdecode(extension))
+                self.extension_index.append(extension_id)
+        return self.extension_index
+
+    def add_extension(self, extension):
+        extension_id = self.extension_ids.get(extension)
+        if extension_id is None:
+            extension_id = self.extension_ids[extension] = len(self.extension_names)
+            self.extension_names.append(extension)
+        return extension_id
+
+    @staticmethod
+    def ranked(index, values):
+        # Replaces ids into values by their position in sorted order
+        used = sorted(set(index), key=values.__getitem__)
+        rank = {value_id: position for position, value_id in enumerate(used)}
+        return array('q', (rank[value_id] for value_id in index))
+
+    def extensions(self):
+        self.extensions_of_rows()
+        return sorted(self.extension_names)
+
+    def order(self, key, descending=False):
+        # Row numbers sorted by key, ties kept in group order
+        cached = self.orders.get((key, descending))
+        if cached is None:
+            column = self.column(key)
+            cached = sorted(range(len(self.group_ids)), key=column.__getitem__, reverse=descending)
+            self.orders[(key, descending)] = cached
+        return cached
+
+    def view(self, key='reclaimable', descending=True, extension=None, directory=None, min_reclaimable=0,
+             min_count=0):
+        # Rows of groups that still exist and pass the filters, in sort order. directory matches
+        # any kept file whose folder path contains it, case-insensitively.
+        groups = self.duplicates.groups
+        group_ids = self.group_ids
+        if len(groups) == len(group_ids):
+            # No group was removed since the table was built
+            rows = list(self.order(key, descending))
+        else:
+            rows = [row for row in self.order(key, descending) if group_ids[row] in groups]
+        if extension:
+            extension = extension.lower() if extension.startswith('.') else f".{extension.lower()}"
+            extension_index = self.extensions_of_rows()
+            extension_id = self.extension_ids.get(extension)
+            rows = [row for row in rows if extension_index[row] == extension_id]
+        if directory:
+            needle = directory.lower()
+            table = self.duplicates.table
+            matching = {dir_id for dir_id, path in enumerate(table.dirs) if needle in path.lower()}
+            dir_index, keep_ids = table.dir_index, self.keep_ids
+            rows = [row for row in rows if dir_index[keep_ids[row]] in matching]
+        if min_reclaimable:
+            reclaimable = self.columns['reclaimable']
+            rows = [row for row in rows if reclaimable[row] >= min_reclaimable]
+        if min_count:
+            counts = self.columns['count']
+            rows = [row for row in rows if counts[row] >= min_count]
+        return rows
+
+    def update(self, group_id):
+        # Refreshes a group's values after some of its files were handled; a removed group just
+        # drops out of every view. Sort orders are recomputed on the next sort.
+        row = self.rows.get(group_id)
+        if row is None:
+            return
+        reclaimable = self.columns['reclaimable']
+        self.redundant_total -= self.redundant[row]
+        self.reclaimable_total -= reclaimable[row]
+        group = self.duplicates.groups.get(group_id)
+        if group is None:
+            # Counts nothing from now on, so updating it again changes no total
+            self.redundant[row] = reclaimable[row] = 0
+            return
+        if self.keep_ids[row] != group.keep:
+            # The new kept file can be in another folder or have another extension
+            self.keep_ids[row] = group.keep
+            self.columns.pop('extension', None)
+            self.columns.pop('directory', None)
+            self.extension_index = None
+        reclaimable[row] = self.duplicates.reclaimable_bytes(group)
+        self.redundant[row] = len(self.duplicates.redundant(group))
+        self.redundant_total += self.redundant[row]
+        self.reclaimable_total += reclaimable[row]
+        self.columns['count'][row] = len(group)
+        self.orders.clear()
+
+    def group_id(self, row):
+        return self.group_ids[row]
+
+    def row_values(self, row):
+        # (reclaimable bytes, files, file size, kept file name, folder of the kept file)
+        table = self.duplicates.table
+        keep = self.keep_ids[row]
+        return (self.columns['reclaimable'][row], self.columns['count'][row], self.columns['size'][row],
+                table.name(keep), table.directory(keep))
+
+    def total_reclaimable(self, rows):
+        reclaimable = self.columns['reclaimable']
+        return sum(reclaimable[row] for row in rows)
@@ -0,0 +1,199 @@
+import os
+import time
+
+from .actions import QUARANTINE_DIR
+from .records import stat_key
+
+# What the walk does with symbolic links:
+#   skip    - ignore them, nothing is read through a link
+#   files   - symlinked files are listed under the link's name, symlinked directories are not entered
+#   follow  - also descend into symlinked directories, each directory is only walked once
+SYMLINK_POLICIES = ('skip', 'files', 'follow')
+
+# Recorded as the mtime of a directory that could not be read completely. It stays known to the
+# directory above it, whose saved subdirectory list comes from the recorded directories, but
+# never matches a real mtime, so the next scan lists it again instead of trusting it.
+UNREAD_MTIME = -1
+
+class WalkOptions:
+    # How a directory tree is walked, shared by the plain and the incremental scan
+    def __init__(self, recursive=True, symlinks='skip', one_filesystem=False, log=print, telemetry=None,
+                 error_log=None):
+        if symlinks not in SYMLINK_POLICIES:
+            raise ValueError(f"Unknown symlink policy: {symlinks}")
+        self.recursive = recursive
+        self.symlinks = symlinks
+        self.one_filesystem = one_filesystem
+        self.log = log
+        # Where entries that could not be read are reported, log unless given
+        self.error_log = error_log or log
+        # telemetry.ScanTelemetry, told how long every directory took to list
+        self.telemetry = telemetry
+        self.root_device = None
+        self.visited = set()
+        # When a set, every directory whose entries were all read goes into it; files below any
+        # other directory were not necessarily seen by the walk
+        self.listed = None
+
+    def signature(self):
+        # Scans are only comparable when they walked the tree the same way
+        return f"recursive={int(self.recursive)},symlinks={self.symlinks},one_filesystem={int(self.one_filesystem)}"
+
+    def start(self, directory):
+        self.visited = set()
+        self.root_device = os.stat(directory).st_dev if self.one_filesystem else None
+
+    def enter(self, current):
+        # False for a directory reached a second time through a symlink
+        if self.symlinks != 'follow':
+            return True
+        st = os.stat(current)
+        key = (st.st_dev, st.st_ino)
+        if key in self.visited:
+            return False
+        self.visited.add(key)
+        return True
+
+def list_directory(current, options):
+    # One level of the walk: (files as (name, stat), subdirectory paths, entries that could not
+    # be read).
+    # DirEntry caches the type and stat information, so every file costs at most one stat call
+    # (none on Windows, where the directory listing already carries it).
+    files = []
+    subdirs = []
+    errors = 0
+    with os.scandir(current) as entries:
+        for entry in entries:
+            try:
+                is_symlink = entry.is_symlink()
+                if is_symlink and options.symlinks == 'skip':
+                    continue
+                if entry.is_dir():
+                    if not options.recursive or (is_symlink and options.symlinks != 'follow'):
+                        continue
+                    # Files moved aside by an earlier cleanup are not duplicates to find again
+                    if entry.name == QUARANTINE_DIR:
+                        continue
+                    if options.root_device is not None and entry.stat().st_dev != options.root_device:
+                        options.log(f"Skipping {entry.path}: on another filesystem")
+                        continue
+                    subdirs.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+                files.append((entry.name, entry.stat()))
+            except OSError as e:
+                errors += 1
+                options.error_log(f"Error reading {entry.path}: {str(e)}")
+    return files, subdirs, errors
+
+def scan_directory(directory, recursive=True, progress=None, log=print, options=None):
+    # Walks the tree once with os.scandir and yields (directory, name, stat) per file as soon as
+    # its directory is listed
+    options = options or WalkOptions(recursive, log=log)
+    log = options.error_log
+    try:
+        options.start(directory)
+    except OSError as e:
+        log(f"Error reading {directory}: {str(e)}")
+        return
+    pending = [directory]
+    dirs_found = 1
+    dirs_done = 0
+    while pending:
+        current = pending.pop()
+        start = time.perf_counter()
+        try:
+            if not options.enter(current):
+                continue
+            files, subdirs, errors = list_directory(current, options)
+            if not errors and options.listed is not None:
+                options.listed.add(current)
+        except OSError as e:
+            log(f"Error reading {current}: {str(e)}")
+            files, subdirs = [], []
+        if options.telemetry is not None:
+            options.telemetry.directory_listed(current, time.perf_counter() - start, len(files))
+        pending.extend(subdirs)
+        dirs_found += len(subdirs)
+        for name, st in files:
+            yield current, name, st
+        dirs_done += 1
+        if progress:
+            # The total grows while subdirectories are discovered
+            progress(dirs_done, dirs_found)
+
+def scan_incremental(directory, previous, progress=None, options=None):
+    # Like scan_directory, but yields (directory, name, stat, digest) and reuses a previous scan
+    # (see manifest.ScanManifest.load). A directory whose mtime did not change still has the same
+    # entries, so it is not listed again; its known files are only restat'ed, and files whose stat
+    # key is unchanged keep their digest. Fills previous.dir_mtimes and the change counters.
+    # Directories that were not read without errors get UNREAD_MTIME recorded: the next scan
+    # trusts a directory with its real mtime to hold exactly the files saved for it.
+    options = options or WalkOptions()
+    log = options.error_log
+    try:
+        options.start(directory)
+    except OSError as e:
+        log(f"Error reading {directory}: {str(e)}")
+        return
+    pending = [directory]
+    dirs_found = 1
+    dirs_done = 0
+    while pending:
+        current = pending.pop()
+        start = time.perf_counter()
+        try:
+            if not options.enter(current):
+                continue
+            mtime_ns = os.stat(current).st_mtime_ns
+        except OSError as e:
+            log(f"Error reading {current}: {str(e)}")
+            previous.dir_mtimes[current] = UNREAD_MTIME
+            continue
+        known_files = previous.files.get(current, {})
+        complete = True
+
+        if previous.is_unchanged(current, mtime_ns):
+            previous.dirs_skipped += 1
+            subdirs = previous.subdirs.get(current, [])
+            files = []
+            for name in known_files:
+                try:
+                    files.append((name, os.stat(os.path.join(current, name),
+                                                follow_symlinks=options.symlinks != 'skip')))
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    complete = False
+                    log(f"Error reading {os.path.join(current, name)}: {str(e)}")
+        else:
+            previous.dirs_listed += 1
+            try:
+                files, subdirs, errors = list_directory(current, options)
+                complete = not errors
+            except OSError as e:
+                log(f"Error reading {current}: {str(e)}")
+                files, subdirs = [], []
+                complete = False
+        previous.dir_mtimes[current] = mtime_ns if complete else UNREAD_MTIME
+        if complete and options.listed is not None:
+            options.listed.add(current)
+        if options.telemetry is not None:
+            options.telemetry.directory_listed(current, time.perf_counter() - start, len(files))
+
+        pending.extend(subdirs)
+        dirs_found += len(subdirs)
+        for name, st in files:
+            known = known_files.get(name)
+            if known is None:
+                previous.files_added += 1
+                yield current, name, st, None
+            elif known[0] != stat_key(st):
+                previous.files_modified += 1
+                yield current, name, st, None
+            else:
+                yield current, name, st, known[1]
+        dirs_done += 1
+        if progress:
+            progress(dirs_done, dirs_found)
@@ -0,0 +1,215 @@
+# Near-duplicate images through perceptual hashes. Hashing needs Pillow and NumPy, both are
+# only imported once images are actually read, so the constants here are always available.
+import math
+from itertools import combinations
+
+# NumPy, once require_numpy() imported it
+np = None
+
+PERCEPTUAL_HASHES = ('ahash', 'dhash', 'phash')
+DEFAULT_PERCEPTUAL_HASH = 'dhash'
+DEFAULT_THRESHOLD = 6
+HASH_SIZE = 8
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.heic', '.tiff')
+
+# Images are hashed in batches, so the per-image Python overhead stays small
+HASH_BATCH_SIZE = 1024
+
+_dct_matrices = {}
+
+def dct_matrix(n):
+    # Orthonormal DCT-II basis, pHash only needs the top-left corner of the 2-D transform
+    matrix = _dct_matrices.get(n)
+    if matrix is None:
+        k = np.arange(n)[:, None]
+        i = np.arange(n)[None, :]
+        matrix = np.sqrt(2 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+        matrix[0] /= np.sqrt(2)
+        matrix = _dct_matrices[n] = matrix.astype(np.float32)
+    return matrix
+
+def pixel_size(method, hash_size=HASH_SIZE):
+    # (width, height) an image is scaled to before hashing
+    if method == 'dhash':
+        return hash_size + 1, hash_size
+    if method == 'phash':
+        return hash_size * 4, hash_size * 4
+    return hash_size, hash_size
+
+def read_pixels(filepath, method=DEFAULT_PERCEPTUAL_HASH, hash_size=HASH_SIZE):
+    # Worker entry point: the image in grayscale, scaled down to what the hash looks at.
+    # Must stay a module level function so process pools can pickle it.
+    from PIL import Image
+    from .thumbnails import load_image
+
+    require_numpy()
+    size = pixel_size(method, hash_size)
+    img = load_image(filepath, size)
+    if img.mode in ('P', 'LA', 'RGBA'):
+        img = img.convert('RGBA')
+    if img.mode != 'L':
+        img = img.convert('L')
+    return np.asarray(img.resize(size, Image.BILINEAR), dtype=np.uint8)
+
+def require_numpy():
+    # Imports NumPy on first use, every function here that uses np is reached through this
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise RuntimeError("Near-duplicate image mode needs NumPy (pip install numpy)") from None
+        np = numpy
+    return np
+
+def hash_pixels(pixels, method=DEFAULT_PERCEPTUAL_HASH, hash_size=HASH_SIZE):
+    # Hashes a stack of (count, height, width) images at once, one bytes object per image
+    require_numpy()
+    pixels = np.asarray(pixels, dtype=np.float32)
+    count = pixels.shape[0]
+    if method == 'ahash':
+        bits = pixels > pixels.mean(axis=(1, 2), keepdims=True)
+    elif method == 'dhash':
+        bits = pixels[:, :, 1:] > pixels[:, :, :-1]
+    elif method == 'phash':
+        dct = dct_matrix(pixels.shape[1])
+        low = (dct @ pixels @ dct.T)[:, :hash_size, :hash_size].reshape(count, -1)
+        # The DC term only carries the overall brightness
+        bits = low > np.median(low[:, 1:], axis=1, keepdims=True)
+    else:
+        raise ValueError(f"Unknown perceptual hash: {method}")
+    packed = np.packbits(bits.reshape(count, -1), axis=1)
+    return [row.tobytes() for row in packed]
+
+def image_hash(filepath, method=DEFAULT_PERCEPTUAL_HASH, hash_size=HASH_SIZE):
+    return hash_pixels(read_pixels(filepath, method, hash_size)[None], method, hash_size)[0]
+
+_popcount_table = None
+
+def popcount(values):
+    # Set bits per element of a uint64 array
+    global _popcount_table
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    if _popcount_table is None:
+        _popcount_table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return _popcount_table[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+class HammingIndex:
+    # Multi-index hashing over a fixed set of codes of up to 64 bits. Codes are split into chunks,
+    # each kept as a sorted column. Two codes within threshold bits of each other differ in at most
+    # threshold // chunks bits of some chunk, so probing every chunk with that many flipped bits
+    # finds all of them. Probes run for all codes at once, as array operations.
+    ROWS_PER_PROBE = 1 << 18
+    # Chunks up to this width get a dense table of bucket starts instead of a binary search
+    DENSE_CHUNK_BITS = 24
+
+    def __init__(self, codes, bits, threshold):
+        require_numpy()
+        self.codes = np.asarray(codes, dtype=np.uint64)
+        self.bits = bits
+        self.threshold = threshold
+        self.chunks = self.choose_chunks(bits, threshold, len(self.codes))
+        self.radius = threshold // self.chunks
+        bounds = [round(bits * i / self.chunks) for i in range(self.chunks + 1)]
+        self.columns = []
+        for start, end in zip(bounds, bounds[1:]):
+            shift, width_mask = np.uint64(bits - end), np.uint64((1 << (end - start)) - 1)
+            values = (self.codes >> shift) & width_mask
+            order = np.argsort(values, kind='stable')
+            masks = np.array(self.flip_masks(end - start, self.radius), dtype=np.uint64)
+            sorted_values = values[order]
+            if end - start <= self.DENSE_CHUNK_BITS:
+                counts = np.bincount(values.astype(np.intp), minlength=1 << (end - start))
+                buckets = np.concatenate(([0], np.cumsum(counts))).astype(np.int32 if len(values) < 2**31 else np.int64)
+            else:
+                buckets = sorted_values
+            self.columns.append((shift, width_mask, order, sorted_values, buckets, masks))
+
+    @staticmethod
+    def choose_chunks(bits, threshold, expected):
+        # Fewer chunks mean more probes per code, more chunks mean fuller buckets;
+        # pick the count with the fewest expected probes plus candidate checks
+        best, best_cost = 1, None
+        for chunks in range(1, min(threshold + 1, bits) + 1):
+            width = bits // chunks
+            radius = threshold // chunks
+            probes = sum(math.comb(width, k) for k in range(radius + 1))
+            cost = chunks * probes * (1 + expected / 2 ** width)
+            if best_cost is None or cost < best_cost:
+                best, best_cost = chunks, cost
+        return best
+
+    @staticmethod
+    def flip_masks(width, radius):
+        masks = [0]
+        for flips in range(1, min(radius, width) + 1):
+            for positions in combinations(range(width), flips):
+                masks.append(sum(1 << p for p in positions))
+        return masks
+
+    def lookup(self, buckets, probes):
+        # Start of each probe's run in the sorted order, and the length of that run
+        if buckets.dtype != np.uint64:
+            probes = probes.astype(np.intp)
+            low = buckets[probes]
+            return low, buckets[probes + 1] - low
+        low = np.searchsorted(buckets, probes, 'left')
+        return low, np.searchsorted(buckets, probes, 'right') - low
+
+    def pairs(self):
+        # (first, second) position arrays of every pair within threshold bits, first < second.
+        # A pair close in several chunks is reported once per chunk and mask that finds it.
+        codes = self.codes
+        for _, _, order, sorted_values, buckets, masks in self.columns:
+            for mask in masks:
+                # Probing in sorted order keeps the bucket lookups close together in memory
+                for start in range(0, len(codes), self.ROWS_PER_PROBE):
+                    low, counts = self.lookup(buckets, sorted_values[start:start + self.ROWS_PER_PROBE] ^ mask)
+                    hit = np.flatnonzero(counts)
+                    if not len(hit):
+                        continue
+                    low, counts = low[hit], counts[hit]
+                    # Expand every probe into the run of equal chunk values it hit
+                    first = np.repeat(order[start + hit], counts)
+                    run_starts = np.repeat(low - (np.cumsum(counts) - counts), counts)
+                    second = order[np.arange(len(first)) + run_starts]
+                    keep = first < second
+                    first, second = first[keep], second[keep]
+                    close = popcount(codes[first] ^ codes[second]) <= self.threshold
+                    yield first[close], second[close]
+
+class UnionFind:
+    def __init__(self):
+        self.parents = {}
+
+    def find(self, item):
+        parents = self.parents
+        root = item
+        while parents.get(root, root) != root:
+            root = parents[root]
+        while item != root:
+            parents[item], item = root, parents.get(item, item)
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parents.setdefault(root_a, root_a)
+            self.parents[root_b] = root_a
+
+def similar_groups(codes, bits, threshold):
+    # Groups of positions into codes whose images are near duplicates, linked transitively.
+    # Identical codes are grouped up front, only distinct codes go through the index.
+    require_numpy()
+    distinct, inverse = np.unique(np.asarray(codes, dtype=np.uint64), return_inverse=True)
+    links = UnionFind()
+    for first, second in HammingIndex(distinct, bits, threshold).pairs():
+        for a, b in zip(first.tolist(), second.tolist()):
+            links.union(a, b)
+
+    groups = {}
+    find = links.find
+    for position, code in enumerate(inverse.ravel().tolist()):
+        groups.setdefault(find(code), []).append(position)
+    return [group for group in groups.values() if len(group) > 1]
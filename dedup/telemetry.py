@@ -0,0 +1,219 @@
+import cProfile
+import heapq
+import io
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Entries kept in the slowest files and slowest directories lists
+SLOWEST_COUNT = 20
+
+class StageTimer:
+    # Wall and CPU time of one named stage, plus what it read. CPU time far below wall time
+    # means the stage was waiting on the disk, CPU time close to it means Python was the limit.
+    __slots__ = ('wall', 'cpu', 'files', 'bytes', 'read_seconds', 'runs')
+
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.files = 0
+        self.bytes = 0
+        self.read_seconds = 0.0
+        self.runs = 0
+
+    def as_dict(self):
+        return {
+            'wall_seconds': round(self.wall, 4),
+            'cpu_seconds': round(self.cpu, 4),
+            'files': self.files,
+            'bytes_read': self.bytes,
+            # Summed over the workers, so it can exceed the wall time
+            'read_seconds': round(self.read_seconds, 4),
+            'mb_per_second': round(self.bytes / self.wall / 2**20, 1) if self.wall else None,
+        }
+
+class ScanTelemetry:
+    # Structured record of what a scan spent its time on: per-stage wall and CPU time, bytes read,
+    # cache hits, listing time per directory and the slowest files and directories.
+    # Every record is also passed to sink(event) as a dict as it happens, for an event stream;
+    # report() sums it all up. Optionally profiles the calling thread with cProfile, and traces
+    # Python allocations with tracemalloc, for the duration of a session.
+    def __init__(self, sink=None, profile=False, trace_memory=False, slowest=SLOWEST_COUNT):
+        self.sink = sink
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.slowest = slowest
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.session_name = None
+            self.session_wall = 0.0
+            self.stages = {}
+            self.cache = {'hits': 0, 'misses': 0}
+            self.dirs_listed = 0
+            self.dir_seconds = 0.0
+            self.slowest_files = []
+            self.slowest_dirs = []
+            self.errors = 0
+            self.profile_text = None
+            self.memory = None
+            self.counters = {}
+
+    def emit(self, event, **fields):
+        if self.sink is not None:
+            self.sink({'event': event, 'time': round(time.time(), 6), **fields})
+
+    def timer(self, stage):
+        timer = self.stages.get(stage)
+        if timer is None:
+            timer = self.stages[stage] = StageTimer()
+        return timer
+
+    @contextmanager
+    def session(self, name, **fields):
+        # One comparison; resets the previous record and wraps it in the optional profilers
+        self.reset()
+        self.session_name = name
+        self.emit('session_start', name=name, **fields)
+        profiler = cProfile.Profile() if self.profile else None
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start(10)
+        if profiler is not None:
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.session_wall = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self.profile_text = self.format_profile(profiler)
+            if tracing:
+                self.memory = self.memory_report()
+                tracemalloc.stop()
+            self.emit('session_end', name=name, wall_seconds=round(self.session_wall, 4))
+
+    @contextmanager
+    def stage(self, name):
+        self.emit('stage_start', stage=name)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield self
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            with self.lock:
+                timer = self.timer(name)
+                timer.wall += wall
+                timer.cpu += cpu
+                timer.runs += 1
+            self.emit('stage_end', stage=name, wall_seconds=round(wall, 4), cpu_seconds=round(cpu, 4))
+
+    def remember_slowest(self, heap, entry):
+        # Min-heap of the N largest entries, so a new file only costs a comparison with the smallest
+        if len(heap) < self.slowest:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    def file_read(self, stage, path, seconds, bytes_read):
+        with self.lock:
+            timer = self.timer(stage)
+            timer.files += 1
+            timer.bytes += bytes_read
+            timer.read_seconds += seconds
+            self.remember_slowest(self.slowest_files, (seconds, path, stage, bytes_read))
+        if self.sink is not None:
+            self.emit('file', stage=stage, path=path, seconds=round(seconds, 6), bytes=bytes_read)
+
+    def file_error(self, stage, path, error):
+        with self.lock:
+            self.errors += 1
+        self.emit('error', stage=stage, path=path, message=str(error))
+
+    def directory_listed(self, path, seconds, files):
+        with self.lock:
+            self.dirs_listed += 1
+            self.dir_seconds += seconds
+            self.remember_slowest(self.slowest_dirs, (seconds, path, files))
+        if self.sink is not None:
+            self.emit('directory', path=path, seconds=round(seconds, 6), files=files)
+
+    def cache_lookups(self, hits, misses):
+        with self.lock:
+            self.cache['hits'] += hits
+            self.cache['misses'] += misses
+        self.emit('cache', hits=hits, misses=misses)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @staticmethod
+    def format_profile(profiler, limit=30):
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    @staticmethod
+    def memory_report(limit=10):
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:limit]
+        return {
+            'current_bytes': current,
+            'peak_bytes': peak,
+            'top': [{'where': str(stat.traceback), 'bytes': stat.size, 'blocks': stat.count} for stat in top],
+        }
+
+    def report(self):
+        with self.lock:
+            report = {
+                'session': self.session_name,
+                'started': self.started,
+                'wall_seconds': round(self.session_wall, 4),
+                'stages': {name: timer.as_dict() for name, timer in self.stages.items()},
+                'cache': dict(self.cache),
+                'directories': {
+                    'listed': self.dirs_listed,
+                    'seconds': round(self.dir_seconds, 4),
+                    'slowest': [{'path': path, 'seconds': round(seconds, 6), 'files': files}
+                                for seconds, path, files in sorted(self.slowest_dirs, reverse=True)],
+                },
+                'slowest_files': [{'path': path, 'stage': stage, 'seconds': round(seconds, 6), 'bytes': size}
+                                  for seconds, path, stage, size in sorted(self.slowest_files, reverse=True)],
+                'errors': self.errors,
+                'counters': dict(self.counters),
+            }
+        if self.profile_text is not None:
+            report['profile'] = self.profile_text
+        if self.memory is not None:
+            report['memory'] = self.memory
+        return report
+
+    def format_summary(self):
+        # One line per stage, for logs
+        lines = []
+        for name, timer in self.stages.items():
+            line = f"{name}: {timer.wall:.2f} s wall, {timer.cpu:.2f} s CPU"
+            if timer.bytes:
+                line += f", {timer.files} files, {timer.bytes / 2**20:.1f} MB"
+            lines.append(line)
+        if self.dirs_listed:
+            lines.append(f"{self.dirs_listed} folders listed in {self.dir_seconds:.2f} s")
+        return "; ".join(lines)
+
+def json_lines_sink(stream):
+    # Writes every event as one JSON line; safe to call from several threads
+    lock = threading.Lock()
+
+    def sink(event):
+        line = json.dumps(event)
+        with lock:
+            stream.write(line + "\n")
+    return sink
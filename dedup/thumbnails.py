@@ -0,0 +1,193 @@
+# Preview thumbnails for the review viewer. Needs Pillow, so dedup/__init__ does not import it.
+import hashlib
+import os
+import threading
+from collections import OrderedDict, deque
+
+from PIL import Image, UnidentifiedImageError
+
+from .utils import get_config_dir
+
+def load_image(filepath, target_size=None):
+    # With a target size JPEGs are decoded at the smallest DCT scale that still covers it,
+    # so a 20 MP photo never has to be decoded at full resolution for a 400 px preview
+    if filepath.lower().endswith('.heic'):
+        import pillow_heif
+        heif_file = pillow_heif.read_heif(filepath)
+        return Image.frombytes(
+            heif_file.mode,
+            heif_file.size,
+            heif_file.data,
+            "raw",
+        )
+    img = Image.open(filepath)
+    if target_size is not None:
+        img.draft('RGB', target_size)
+    return img
+
+def make_thumbnail(filepath, target_size):
+    # The image scaled to fit target_size, centered on a white background
+    img = load_image(filepath, target_size)
+    img.thumbnail(target_size)
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGBA')
+    background = Image.new('RGB', target_size, 'white')
+    offset = ((target_size[0] - img.size[0]) // 2, (target_size[1] - img.size[1]) // 2)
+    background.paste(img, offset, img if img.mode == 'RGBA' else None)
+    return background
+
+class ThumbnailCache:
+    # LRU of finished thumbnails in memory, backed by JPEG files on disk, each tier with a byte budget.
+    # Entries are keyed by path, size, mtime and target size, so edited files get a fresh thumbnail.
+    def __init__(self, memory_bytes=64 * 1024 * 1024, disk_bytes=256 * 1024 * 1024, disk_dir=None):
+        if disk_dir is None:
+            disk_dir = os.path.join(get_config_dir(), 'thumbnails')
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.disk_dir = disk_dir
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.disk = OrderedDict()
+        self.disk_used = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.wakeup = threading.Condition(self.lock)
+        self.worker = None
+
+        if disk_bytes:
+            try:
+                os.makedirs(disk_dir, exist_ok=True)
+                # Least recently used files first, hits refresh the mtime
+                entries = sorted(os.scandir(disk_dir), key=lambda entry: entry.stat().st_mtime)
+                for entry in entries:
+                    self.disk[entry.name] = entry.stat().st_size
+                    self.disk_used += entry.stat().st_size
+            except OSError:
+                self.disk_bytes = 0
+
+    def key(self, filepath, target_size):
+        st = os.stat(filepath)
+        return (filepath, st.st_size, st.st_mtime_ns, tuple(target_size))
+
+    def disk_name(self, key):
+        return hashlib.sha1(repr(key).encode('utf-8', 'surrogatepass')).hexdigest() + '.jpg'
+
+    def get(self, filepath, target_size):
+        try:
+            key = self.key(filepath, target_size)
+        except OSError:
+            return None
+        with self.lock:
+            img = self.memory.get(key)
+            if img is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return img
+
+        img = self.load_from_disk(key)
+        if img is None:
+            try:
+                img = make_thumbnail(filepath, target_size)
+            except (UnidentifiedImageError, ImportError, OSError, ValueError) as e:
+                print(f"Error loading image {filepath}: {str(e)}")
+                return None
+            self.save_to_disk(key, img)
+            with self.lock:
+                self.misses += 1
+        self.remember(key, img)
+        return img
+
+    def remember(self, key, img):
+        size = img.size[0] * img.size[1] * len(img.getbands())
+        with self.lock:
+            if key in self.memory:
+                return
+            self.memory[key] = img
+            self.memory_used += size
+            while self.memory_used > self.memory_bytes and len(self.memory) > 1:
+                _, old = self.memory.popitem(last=False)
+                self.memory_used -= old.size[0] * old.size[1] * len(old.getbands())
+
+    def load_from_disk(self, key):
+        if not self.disk_bytes:
+            return None
+        name = self.disk_name(key)
+        with self.lock:
+            if name not in self.disk:
+                return None
+            self.disk.move_to_end(name)
+        path = os.path.join(self.disk_dir, name)
+        try:
+            with Image.open(path) as img:
+                img.load()
+                os.utime(path)
+                with self.lock:
+                    self.disk_hits += 1
+                return img.copy()
+        except (OSError, UnidentifiedImageError):
+            with self.lock:
+                self.disk_used -= self.disk.pop(name, 0)
+            return None
+
+    def save_to_disk(self, key, img):
+        if not self.disk_bytes:
+            return
+        name = self.disk_name(key)
+        path = os.path.join(self.disk_dir, name)
+        try:
+            img.save(path, 'JPEG', quality=85)
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        evicted = []
+        with self.lock:
+            self.disk_used += size - self.disk.pop(name, 0)
+            self.disk[name] = size
+            while self.disk_used > self.disk_bytes and len(self.disk) > 1:
+                old_name, old_size = self.disk.popitem(last=False)
+                self.disk_used -= old_size
+                evicted.append(old_name)
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.disk_dir, old_name))
+            except OSError:
+                pass
+
+    def prefetch(self, filepaths, target_size):
+        # Replaces whatever was still queued, only the neighbours of the current pair matter
+        with self.wakeup:
+            self.pending.clear()
+            self.pending.extend((filepath, tuple(target_size)) for filepath in filepaths)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.prefetch_worker, daemon=True)
+                self.worker.start()
+            self.wakeup.notify()
+
+    def prefetch_worker(self):
+        while True:
+            with self.wakeup:
+                while not self.pending:
+                    self.wakeup.wait()
+                filepath, target_size = self.pending.popleft()
+            self.get(filepath, target_size)
+
+    def clear(self):
+        with self.lock:
+            self.pending.clear()
+            self.memory.clear()
+            self.memory_used = 0
+            names = list(self.disk)
+            self.disk.clear()
+            self.disk_used = 0
+        for name in names:
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except OSError:
+                pass
+
+    def format_stats(self):
+        return (f"thumbnails: {self.hits} memory hits, {self.disk_hits} disk hits, {self.misses} decoded, "
+                f"{self.memory_used / 2**20:.1f} MB in memory, {self.disk_used / 2**20:.1f} MB on disk")
@@ -1,13 +1,45 @@
+import json
 import os
-import hashlib
+import sqlite3
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-from PIL import Image, ImageTk, UnidentifiedImageError
-import pandas as pd
+from PIL import Image, ImageTk
 from datetime import datetime
 from pathlib import Path
 import threading
-from tqdm import tqdm
+
+from dedup import (
+    DEFAULT_ALGORITHM, DEFAULT_PERCEPTUAL_HASH, DEFAULT_THRESHOLD, HASH_ALGORITHMS, MMAP_THRESHOLD, PERCEPTUAL_HASHES,
+    SYMLINK_POLICIES,
+    DuplicateFinder, GroupTable, HashCache, HashExecutor, ProgressTracker, ScanCancelled, ScanManifest, ScanTelemetry,
+    format_progress, format_size,
+)
+from dedup.actions import (
+    ACTIONS, QUARANTINE_DIR, apply_action, create_journal, resume_action, rollback_action,
+)
+from dedup.journal import ActionJournal, journal_dir, unfinished_journals
+from dedup.results import load_results, results_header, save_results
+from dedup.thumbnails import ThumbnailCache
+
+# How often the Tk main loop redraws progress reported by the worker threads
+PROGRESS_INTERVAL_MS = 100
+# How long closing the window waits for a cancelled comparison to save its checkpoint
+CLOSE_TIMEOUT_S = 30
+
+# Pairs on each side of the current one whose thumbnails are decoded in the background
+PREFETCH_PAIRS = 3
+
+# Rows of the duplicate group list; only these exist as Treeview items, whatever the number of groups
+GROUP_ROWS = 12
+# Column, heading and width of the duplicate group list; columns are named by the key they sort by,
+# so the kept file column sorts by extension
+GROUP_COLUMNS = (
+    ('reclaimable', "Reclaimable", 100),
+    ('count', "Files", 60),
+    ('size', "File size", 90),
+    ('extension', "Kept file", 220),
+    ('directory', "Folder", 360),
+)
 
 class FileComparisonUI:
     def __init__(self, root):
@@ -15,19 +47,64 @@ class FileComparisonUI:
         self.root.title("File Comparison Tool")
         self.root.geometry("1000x820")
         self.root.resizable(True, True)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         self.root.minsize(800, 600)
         
         # Variables
         self.dir1 = tk.StringVar()
         self.dir2 = tk.StringVar()
-        self.matches = []
+        self.duplicates = None
+        self.matches = []  # (group, left file, right file) pairs of the group being viewed
         self.current_index = 0
+        self.group_position = 0  # Position in group_rows of the group being viewed
         self.checkboxes = []
+        self.group_table = None
+        self.group_rows = []  # Rows of group_table passing the filters, in sort order
+        self.group_first = 0  # First of group_rows shown in the list
+        self.group_sort = ('reclaimable', True)
+        self.group_extension = tk.StringVar()
+        self.group_directory = tk.StringVar()
+        self.group_min_size = tk.StringVar()
+        self.group_min_count = tk.StringVar()
         self.delete_from = tk.StringVar(value="dir2")
+        self.dedup_action = tk.StringVar(value='delete')
         self.total_matches = tk.StringVar(value="No comparison performed yet")
         self.single_dir_mode = tk.BooleanVar(value=False)
         self.include_subfolders = tk.BooleanVar(value=True)
         self.display_full_path = tk.BooleanVar(value=False)
+        self.scan_stats = tk.StringVar(value="")
+        self.use_hash_cache = tk.BooleanVar(value=True)
+        self.use_manifest = tk.BooleanVar(value=True)
+        self.symlink_policy = tk.StringVar(value='skip')
+        self.one_filesystem = tk.BooleanVar(value=False)
+        self.hash_workers = tk.IntVar(value=os.cpu_count() or 1)
+        self.hash_backend = tk.StringVar(value='thread')
+        self.hash_algorithm = tk.StringVar(value=DEFAULT_ALGORITHM)
+        self.memory_map = tk.BooleanVar(value=False)  # Local disks only, a failed mapped read crashes
+        self.similar_images = tk.BooleanVar(value=False)
+        self.perceptual_hash = tk.StringVar(value=DEFAULT_PERCEPTUAL_HASH)
+        self.similarity_threshold = tk.IntVar(value=DEFAULT_THRESHOLD)
+        self.result_algorithm = None  # Algorithm the digests in the current results were made with
+        self.result_stats = ""  # Bytes read per stage by the scan the current results came from
+        self.progress_tracker = ProgressTracker()
+        self.telemetry = ScanTelemetry()
+        self.comparison_result = None
+        self.comparison_thread = None  # Worker thread of the running comparison or cleanup
+        self.running_finder = None
+        self.cleanup_cancel = None  # threading.Event of the running cleanup
+        self.click_journals = {}  # Quarantine folder -> journal of the files quarantined one at a time
+        self.finish_worker = None  # Called on the Tk thread once the worker thread is done
+        self.hash_cache = None
+        self.manifest = None
+        self.thumbnails = ThumbnailCache()
+
+        # Block sizes for the partial hashing stages, tune per storage tier
+        self.hash_stage_options = {
+            'head_size': 64 * 1024,
+            'tail_size': 64 * 1024,
+            'middle_samples': 2,
+            'middle_size': 64 * 1024
+        }
         
         # Add supported file types
         self.supported_types = {
@@ -62,6 +139,7 @@ class FileComparisonUI:
         self.scrollbar.pack(side="right", fill="y")
 
         self.setup_ui()
+        self.root.after(0, self.offer_resume)
         
     def on_canvas_configure(self, event):
         # Update the canvas window to match canvas width
@@ -82,6 +160,12 @@ class FileComparisonUI:
                        variable=self.include_subfolders).pack(side='left', padx=5)
         ttk.Checkbutton(mode_frame, text="Show Full Paths", 
                        variable=self.display_full_path).pack(side='left', padx=5)
+        ttk.Checkbutton(mode_frame, text="Use Hash Cache", 
+                       variable=self.use_hash_cache).pack(side='left', padx=5)
+        ttk.Checkbutton(mode_frame, text="Incremental Rescan", 
+                       variable=self.use_manifest).pack(side='left', padx=5)
+        ttk.Button(mode_frame, text="Clear Hash Cache", 
+                  command=self.clear_hash_cache).pack(side='left', padx=5)
         
         # Directory 1
         ttk.Label(dir_frame, text="Directory 1:").grid(row=1, column=0, padx=5, pady=5)
@@ -98,7 +182,41 @@ class FileComparisonUI:
         browse2.grid(row=2, column=2, padx=5)
         self.dir2_widgets.extend([label2, entry2, browse2])
         
-        ttk.Button(dir_frame, text="Compare", command=self.start_comparison).grid(row=3, column=1, pady=10)
+        # Hashing options
+        hash_frame = ttk.Frame(dir_frame)
+        hash_frame.grid(row=3, column=0, columnspan=3, pady=5)
+        ttk.Label(hash_frame, text="Hash workers:").pack(side='left', padx=5)
+        ttk.Spinbox(hash_frame, from_=1, to=256, width=5,
+                   textvariable=self.hash_workers).pack(side='left', padx=5)
+        ttk.Label(hash_frame, text="Backend:").pack(side='left', padx=5)
+        ttk.Combobox(hash_frame, textvariable=self.hash_backend, values=HashExecutor.BACKENDS,
+                    state='readonly', width=8).pack(side='left', padx=5)
+        ttk.Label(hash_frame, text="Algorithm:").pack(side='left', padx=5)
+        ttk.Combobox(hash_frame, textvariable=self.hash_algorithm, values=list(HASH_ALGORITHMS),
+                    state='readonly', width=10).pack(side='left', padx=5)
+        ttk.Checkbutton(hash_frame, text="Memory-map",
+                       variable=self.memory_map).pack(side='left', padx=5)
+        ttk.Label(hash_frame, text="Symlinks:").pack(side='left', padx=5)
+        ttk.Combobox(hash_frame, textvariable=self.symlink_policy, values=SYMLINK_POLICIES,
+                    state='readonly', width=7).pack(side='left', padx=5)
+        ttk.Checkbutton(hash_frame, text="One Filesystem", 
+                       variable=self.one_filesystem).pack(side='left', padx=5)
+        
+        # Near-duplicate images by perceptual hash
+        similar_frame = ttk.Frame(dir_frame)
+        similar_frame.grid(row=4, column=0, columnspan=3, pady=5)
+        ttk.Checkbutton(similar_frame, text="Similar Images", 
+                       variable=self.similar_images).pack(side='left', padx=5)
+        ttk.Combobox(similar_frame, textvariable=self.perceptual_hash, values=PERCEPTUAL_HASHES,
+                    state='readonly', width=8).pack(side='left', padx=5)
+        ttk.Label(similar_frame, text="Max differing bits:").pack(side='left', padx=5)
+        ttk.Spinbox(similar_frame, from_=0, to=32, width=5,
+                   textvariable=self.similarity_threshold).pack(side='left', padx=5)
+        
+        self.compare_button = ttk.Button(dir_frame, text="Compare", command=self.start_comparison)
+        self.compare_button.grid(row=5, column=1, pady=10)
+        self.cancel_button = ttk.Button(dir_frame, text="Cancel", command=self.cancel_comparison, state='disabled')
+        self.cancel_button.grid(row=5, column=2, pady=10)
         
         # Progress Frame
         progress_frame = ttk.Frame(self.scrollable_frame)
@@ -151,32 +269,127 @@ class FileComparisonUI:
         
         ttk.Button(nav_frame, text="Previous", command=self.show_previous).pack(side='left', padx=5)
         ttk.Button(nav_frame, text="Next", command=self.show_next).pack(side='left', padx=5)
+        ttk.Combobox(nav_frame, textvariable=self.dedup_action, values=ACTIONS,
+                    state='readonly', width=9).pack(side='right', padx=5)
+        ttk.Label(nav_frame, text="Duplicates are handled by:").pack(side='right', padx=5)
         
         # Results Label
         results_frame = ttk.LabelFrame(self.scrollable_frame, text="Results")
         results_frame.pack(fill='x', padx=5, pady=5)
         ttk.Label(results_frame, textvariable=self.total_matches).pack(padx=5, pady=5)
+        ttk.Label(results_frame, textvariable=self.scan_stats).pack(padx=5, pady=(0, 5))
+        journal_frame = ttk.Frame(results_frame)
+        journal_frame.pack(padx=5, pady=(0, 5))
+        ttk.Button(journal_frame, text="Save Scan Report", 
+                  command=self.save_scan_report).pack(side='left', padx=5)
+        ttk.Button(journal_frame, text="Save Results...",
+                  command=self.save_results_file).pack(side='left', padx=5)
+        ttk.Button(journal_frame, text="Open Results...",
+                  command=self.open_results_file).pack(side='left', padx=5)
+        ttk.Button(journal_frame, text="Resume Cleanup...",
+                  command=self.resume_cleanup).pack(side='left', padx=5)
+        ttk.Button(journal_frame, text="Undo Quarantine...",
+                  command=self.rollback_cleanup).pack(side='left', padx=5)
+
+        # Duplicate groups, sortable and filterable; selecting one shows its files above
+        groups_frame = ttk.LabelFrame(self.scrollable_frame, text="Duplicate Groups")
+        groups_frame.pack(fill='x', padx=5, pady=5)
+        filter_frame = ttk.Frame(groups_frame)
+        filter_frame.pack(fill='x', padx=5, pady=5)
+        ttk.Label(filter_frame, text="Extension:").pack(side='left', padx=(0, 5))
+        self.extension_filter = ttk.Combobox(filter_frame, textvariable=self.group_extension, width=8,
+                                             postcommand=self.fill_extension_filter)
+        self.extension_filter.pack(side='left', padx=(0, 10))
+        ttk.Label(filter_frame, text="Folder contains:").pack(side='left', padx=(0, 5))
+        ttk.Entry(filter_frame, textvariable=self.group_directory, width=30).pack(side='left', padx=(0, 10))
+        ttk.Label(filter_frame, text="Min. reclaimable (MB):").pack(side='left', padx=(0, 5))
+        ttk.Entry(filter_frame, textvariable=self.group_min_size, width=6).pack(side='left', padx=(0, 10))
+        ttk.Label(filter_frame, text="Min. files:").pack(side='left', padx=(0, 5))
+        ttk.Entry(filter_frame, textvariable=self.group_min_count, width=4).pack(side='left', padx=(0, 10))
+        ttk.Button(filter_frame, text="Apply", command=self.filter_groups).pack(side='left')
+
+        list_frame = ttk.Frame(groups_frame)
+        list_frame.pack(fill='x', padx=5, pady=(0, 5))
+        self.group_tree = ttk.Treeview(list_frame, columns=[key for key, _, _ in GROUP_COLUMNS], show='headings',
+                                       height=GROUP_ROWS, selectmode='browse')
+        for key, title, width in GROUP_COLUMNS:
+            self.group_tree.heading(key, text=title, command=lambda key=key: self.sort_groups(key))
+            self.group_tree.column(key, width=width, anchor='e' if key in ('reclaimable', 'count', 'size') else 'w')
+        # The Treeview never holds more than one screen of rows, so it gets its own scrollbar
+        # that moves the window of rows shown instead of scrolling the items
+        self.group_scrollbar = ttk.Scrollbar(list_frame, orient='vertical', command=self.scroll_groups)
+        self.group_tree.pack(side='left', fill='x', expand=True)
+        self.group_scrollbar.pack(side='right', fill='y')
+        self.group_tree.bind('<<TreeviewSelect>>', self.on_group_selected)
+        self.group_tree.bind('<MouseWheel>', self.on_group_wheel)
+        self.group_tree.bind('<Button-4>', self.on_group_wheel)
+        self.group_tree.bind('<Button-5>', self.on_group_wheel)
 
     def browse_directory(self, dir_var):
         directory = filedialog.askdirectory()
         if directory:
             dir_var.set(directory)
     
-    def get_file_hash(self, filepath):
-        hash_md5 = hashlib.md5()
-        with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+    def open_hash_cache(self):
+        if not self.use_hash_cache.get():
+            if self.hash_cache is not None:
+                self.hash_cache.close()
+                self.hash_cache = None
+            return None
+        if self.hash_cache is None:
+            try:
+                self.hash_cache = HashCache()
+            except (OSError, sqlite3.Error) as e:
+                print(f"Hash cache unavailable: {str(e)}")
+                return None
+        return self.hash_cache
+
+    def open_manifest(self):
+        if not self.use_manifest.get():
+            if self.manifest is not None:
+                self.manifest.close()
+                self.manifest = None
+            return None
+        if self.manifest is None:
+            try:
+                self.manifest = ScanManifest()
+            except (OSError, sqlite3.Error) as e:
+                print(f"Scan manifest unavailable: {str(e)}")
+                return None
+        return self.manifest
+
+    def clear_hash_cache(self):
+        if not messagebox.askyesno("Clear Hash Cache", "Forget all cached file hashes and previous scans?"):
+            return
+        try:
+            cache = self.hash_cache or HashCache()
+            cache.clear()
+            self.hash_cache = cache
+            manifest = self.manifest or ScanManifest()
+            manifest.forget()
+            self.manifest = manifest
+        except (OSError, sqlite3.Error) as e:
+            messagebox.showerror("Error", f"Failed to clear hash cache: {str(e)}")
     
+    def worker_busy(self):
+        if self.comparison_thread is not None and self.comparison_thread.is_alive():
+            messagebox.showinfo("Comparison Running", "A comparison or cleanup is already running, cancel it first.")
+            return True
+        return False
+
     def start_comparison(self):
+        if self.worker_busy():
+            return
         if not self.dir1.get() or (not self.dir2.get() and not self.single_dir_mode.get()):
             messagebox.showerror("Error", "Please select both directories or enable Single Directory Mode")
             return
             
         # Reset variables
+        self.duplicates = None
+        self.group_table = None
         self.matches = []
         self.current_index = 0
+        self.group_position = 0
         self.checkboxes = []
         
         # Make sure progress bar and label are visible before starting
@@ -184,11 +397,35 @@ class FileComparisonUI:
         self.processing_label.pack(side='top', pady=2)
         self.progress_var.set(0)
         self.processing_label.config(text="Starting comparison...")
-        self.root.update_idletasks()
         
-        # Start comparison in a separate thread
-        thread = threading.Thread(target=self.compare_directories)
-        thread.start()
+        # Read all settings here, the worker thread never touches Tk
+        self.open_hash_cache()
+        self.open_manifest()
+        self.progress_tracker.reset()
+        self.comparison_result = None
+        finder = self.create_finder()
+        directories = [self.dir1.get()] if self.single_dir_mode.get() else [self.dir1.get(), self.dir2.get()]
+        if self.similar_images.get():
+            try:
+                threshold = self.similarity_threshold.get()
+            except tk.TclError:
+                threshold = DEFAULT_THRESHOLD
+            extensions, method = self.supported_types['images'], self.perceptual_hash.get()
+            compare = lambda *dirs: finder.compare_similar_images(list(dirs), extensions, method, threshold)
+            args = (finder, compare, *directories)
+        elif self.single_dir_mode.get():
+            args = (finder, finder.compare_single_directory, self.dir1.get())
+        else:
+            args = (finder, finder.compare_two_directories, self.dir1.get(), self.dir2.get())
+
+        # Start comparison in a separate thread, the main loop polls its progress
+        self.running_finder = finder
+        self.finish_worker = self.finish_comparison
+        self.compare_button.config(state='disabled')
+        self.cancel_button.config(state='normal')
+        self.comparison_thread = threading.Thread(target=self.run_comparison, args=args, daemon=True)
+        self.comparison_thread.start()
+        self.root.after(PROGRESS_INTERVAL_MS, self.poll_progress)
     
     def toggle_mode(self):
         # Show/hide directory 2 widgets based on mode
@@ -200,194 +437,448 @@ class FileComparisonUI:
             for widget in self.dir2_widgets:
                 widget.grid()
 
-    def compare_directories(self):
-        if self.single_dir_mode.get():
-            self.compare_single_directory()
-        else:
-            self.compare_two_directories()
-
-    def update_progress(self, current, total, status_text):
-        progress = (current / total * 100) if total > 0 else 0
-        self.progress_var.set(progress)
-        self.processing_label.config(text=status_text)
-        self.root.update_idletasks()
-
-    def compare_single_directory(self):
-        dir1 = self.dir1.get()
-        files = []
-        hash_map = {}
-        
-        # Count total files first
-        if self.include_subfolders.get():
-            total_files = sum(len(files) for _, _, files in os.walk(dir1))
-        else:
-            total_files = len([f for f in os.listdir(dir1) if os.path.isfile(os.path.join(dir1, f))])
-        processed_files = 0
-        
-        if self.include_subfolders.get():
-            walk_iter = os.walk(dir1)
-        else:
-            # Only process files in the root directory
-            walk_iter = [(dir1, [], [f for f in os.listdir(dir1) if os.path.isfile(os.path.join(dir1, f))])]
-
-        # Scan directory and calculate hashes
-        for root, _, filenames in walk_iter:
-            for filename in filenames:
-                filepath = os.path.join(root, filename)
-                processed_files += 1
-                self.update_progress(processed_files, total_files, 
-                                   f"Processing file {processed_files} of {total_files}: {filename}")
-                try:
-                    file_hash = self.get_file_hash(filepath)
-                    file_info = {
-                        'path': filepath,
-                        'name': filename,
-                        'size': os.path.getsize(filepath),
-                        'ctime': os.path.getctime(filepath)  # Add creation time
-                    }
-                    files.append(file_info)
-
-                    # Group files by hash
-                    if file_hash in hash_map:
-                        hash_map[file_hash].append(file_info)
-                    else:
-                        hash_map[file_hash] = [file_info]
-                except Exception as e:
-                    print(f"Error processing {filepath}: {str(e)}")
-        
-        # Find duplicates by checking hash groups
-        self.matches = []
-        for file_group in hash_map.values():
-            if len(file_group) > 1:  # If multiple files have the same hash
-                # Sort the group by creation time, keeping the oldest file as the original
-                file_group.sort(key=lambda x: x['ctime'])
-                original = file_group[0]  # The oldest file is considered the original
-                
-                # Create matches between the original and each duplicate
-                for duplicate in file_group[1:]:
-                    if os.path.getsize(original['path']) == os.path.getsize(duplicate['path']):
-                        self.matches.append({
-                            'file1': original['path'],  # Original file (will be kept)
-                            'file2': duplicate['path'],  # Duplicate file (will be deleted)
-                            'is_image': original['path'].lower().endswith(self.supported_types['images']),
-                            'name1': original['name'],
-                            'name2': duplicate['name']
-                        })
-
-        # Update UI
-        self.root.after(0, self.show_comparison)
-
-    def compare_two_directories(self):
-        dir1, dir2 = self.dir1.get(), self.dir2.get()
-        files1 = []
-        files2_map = {}
-        
-        # Count total files
-        if self.include_subfolders.get():
-            total_files = sum(len(files) for _, _, files in os.walk(dir1))
-            total_files += sum(len(files) for _, _, files in os.walk(dir2))
+    def poll_progress(self):
+        snapshot = self.progress_tracker.snapshot()
+        self.progress_var.set(snapshot['percent'])
+        self.processing_label.config(text=format_progress(snapshot))
+        if snapshot['finished']:
+            self.finish_worker()
         else:
-            total_files = len([f for f in os.listdir(dir1) if os.path.isfile(os.path.join(dir1, f))])
-            total_files += len([f for f in os.listdir(dir2) if os.path.isfile(os.path.join(dir2, f))])
-        processed_files = 0
-        
-        # First directory scan
-        self.update_progress(0, total_files, "Scanning first directory...")
-        if self.include_subfolders.get():
-            walk_iter = os.walk(dir1)
+            self.root.after(PROGRESS_INTERVAL_MS, self.poll_progress)
+
+    def create_finder(self):
+        try:
+            workers = self.hash_workers.get()
+        except tk.TclError:
+            workers = None
+        return DuplicateFinder(include_subfolders=self.include_subfolders.get(),
+                               workers=workers,
+                               backend=self.hash_backend.get(),
+                               algorithm=self.hash_algorithm.get(),
+                               mmap_threshold=MMAP_THRESHOLD if self.memory_map.get() else None,
+                               hash_cache=self.hash_cache,
+                               manifest=self.manifest,
+                               symlinks=self.symlink_policy.get(),
+                               one_filesystem=self.one_filesystem.get(),
+                               stage_options=self.hash_stage_options,
+                               progress=self.progress_tracker,
+                               telemetry=self.telemetry)
+
+    def run_comparison(self, finder, compare, *directories):
+        # Runs on the worker thread, poll_progress picks up the result on the Tk thread
+        try:
+            duplicates = compare(*directories)
+            self.comparison_result = (finder, duplicates, None)
+        except Exception as e:
+            self.comparison_result = (finder, None, e)
+        self.progress_tracker.finish()
+
+    def cancel_comparison(self):
+        # The worker stops at its next file and saves a checkpoint, poll_progress then finishes up.
+        # A cleanup finishes the batches it started, the journal has the rest.
+        if self.running_finder is not None:
+            self.running_finder.cancel()
+        elif self.cleanup_cancel is not None:
+            self.cleanup_cancel.set()
         else:
-            # Only process files in the root directory
-            walk_iter = [(dir1, [], [f for f in os.listdir(dir1) if os.path.isfile(os.path.join(dir1, f))])]
-            
-        for root, _, files in walk_iter:
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                processed_files += 1
-                self.update_progress(processed_files, total_files, 
-                                   f"Processing file {processed_files} of {total_files}: {filename}")
-                try:
-                    file_hash = self.get_file_hash(filepath)
-                    files1.append({
-                        'path': filepath,
-                        'hash': file_hash,
-                        'name': filename,
-                        'size': os.path.getsize(filepath)
-                    })
-                except Exception as e:
-                    print(f"Error processing {filepath}: {str(e)}")
-        
-        total_files = len(files1)
+            return
+        self.cancel_button.config(state='disabled')
+        self.processing_label.config(text="Cancelling, saving progress...")
+
+    def on_close(self):
+        # Give a running comparison the chance to write its checkpoint, and a cleanup its journal,
+        # before the process ends
+        if self.comparison_thread is not None and self.comparison_thread.is_alive():
+            if self.running_finder is not None:
+                self.running_finder.cancel()
+            if self.cleanup_cancel is not None:
+                self.cleanup_cancel.set()
+            self.comparison_thread.join(timeout=CLOSE_TIMEOUT_S)
+        for journal in self.click_journals.values():
+            journal.close()
+        self.root.destroy()
+
+    def get_workers(self):
+        try:
+            return self.hash_workers.get()
+        except tk.TclError:
+            return None
+
+    def start_cleanup(self, verb, task, on_done):
+        # Runs task(progress, cancel) on the worker thread with the same progress display and
+        # Cancel button as a comparison; on_done(result, error) then runs on the Tk thread
+        self.cleanup_cancel = threading.Event()
+        self.progress_tracker.reset()
+        self.comparison_result = None
+        self.progress_bar.pack(fill='x', side='top')
+        self.processing_label.pack(side='top', pady=2)
         self.progress_var.set(0)
-        
-        # Build hash map for files2 for faster lookup
-        if self.include_subfolders.get():
-            walk_iter = os.walk(dir2)
-        else:
-            # Only process files in the root directory
-            walk_iter = [(dir2, [], [f for f in os.listdir(dir2) if os.path.isfile(os.path.join(dir2, f))])]
-            
-        self.update_progress(0, total_files, "Building hash map for second directory...")
-        processed_files = 0
-        for root, _, files in walk_iter:
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                processed_files += 1
-                self.update_progress(processed_files, total_files, 
-                                   f"Processing file {processed_files} of {total_files}: {filename}")
-                try:
-                    file_hash = self.get_file_hash(filepath)
-                    if file_hash in files2_map:
-                        files2_map[file_hash].append(filepath)
-                    else:
-                        files2_map[file_hash] = [filepath]
-                except Exception as e:
-                    print(f"Error processing {filepath}: {str(e)}")
-        
-        # Compare files by hash
-        for i, file1 in enumerate(files1):
-            self.progress_var.set((i + 1) / total_files * 100)
+        self.processing_label.config(text=f"{verb}...")
+        self.compare_button.config(state='disabled')
+        self.cancel_button.config(state='normal')
+        self.finish_worker = lambda: self.finish_cleanup(on_done)
+        done_before = [0]
+
+        def progress(done, total):
+            self.progress_tracker.add(files=done - done_before[0])
+            done_before[0] = done
+            self.progress_tracker.update(done, total, f"{verb}: {done} of {total} files")
+
+        def run():
             try:
-                if file1['hash'] in files2_map:
-                    for filepath2 in files2_map[file1['hash']]:
-                        if os.path.getsize(filepath2) == file1['size']:  # Double check size
-                            self.matches.append({
-                                'file1': file1['path'],
-                                'file2': filepath2,
-                                'is_image': file1['path'].lower().endswith(self.supported_types['images']),
-                                'name1': file1['name'],
-                                'name2': os.path.basename(filepath2)
-                            })
-                            break  # Found a match, no need to check other files with same hash
+                self.comparison_result = (task(progress, self.cleanup_cancel), None)
             except Exception as e:
-                print(f"Error comparing {file1['path']}: {str(e)}")
+                self.comparison_result = (None, e)
+            self.progress_tracker.finish()
+
+        self.comparison_thread = threading.Thread(target=run, daemon=True)
+        self.comparison_thread.start()
+        self.root.after(PROGRESS_INTERVAL_MS, self.poll_progress)
+
+    def finish_cleanup(self, on_done):
+        result, error = self.comparison_result
+        self.cleanup_cancel = None
+        self.compare_button.config(state='normal')
+        self.cancel_button.config(state='disabled')
+        self.progress_bar.pack_forget()
+        self.processing_label.pack_forget()
+        on_done(result, error)
+
+    def offer_resume(self):
+        # A cleanup cut off by a crash or by closing the window is picked up on the next start
+        try:
+            unfinished = unfinished_journals()
+            if not unfinished:
+                return
+            with ActionJournal.open(unfinished[0]) as journal:
+                summary = journal.summary()
+        except (OSError, ValueError):
+            return
+        answer = messagebox.askyesnocancel(
+            "Unfinished Cleanup",
+            f"A cleanup ({summary['action']}) started in run {summary['run']} stopped with "
+            f"{summary['pending']} of {summary['jobs']} files left.\n\nFinish it now? "
+            f"No gives it up for good, Cancel asks again next time.")
+        if answer:
+            self.resume_cleanup(unfinished[0])
+        elif answer is not None:
+            try:
+                with ActionJournal.open(unfinished[0]) as journal:
+                    journal.abandon()
+            except (OSError, ValueError) as e:
+                messagebox.showerror("Error", f"Could not give up the cleanup: {str(e)}")
 
-        # Update UI
-        self.root.after(0, self.show_comparison)
+    def choose_journal(self):
+        return filedialog.askopenfilename(initialdir=journal_dir(), title="Cleanup journal",
+                                          filetypes=[("Cleanup journal", "*.jsonl")])
+
+    def resume_cleanup(self, path=None):
+        if self.worker_busy():
+            return
+        path = path or self.choose_journal()
+        if not path:
+            return
+        workers = self.get_workers()
+        self.start_cleanup("Resuming cleanup",
+                           lambda progress, cancel: resume_action(path, workers, progress, cancel),
+                           lambda result, error: self.show_journal_result(result, error, "processed"))
+
+    def rollback_cleanup(self):
+        if self.worker_busy():
+            return
+        path = self.choose_journal()
+        if not path:
+            return
+        workers = self.get_workers()
+        self.start_cleanup("Restoring from quarantine",
+                           lambda progress, cancel: rollback_action(path, workers, progress),
+                           lambda result, error: self.show_journal_result(result, error, "restored"))
+
+    def show_journal_result(self, result, error, verb):
+        # Resumed and rolled back runs can belong to any earlier scan, so the results on screen
+        # are left as they are; comparing again shows the new state
+        if error is not None:
+            messagebox.showerror("Error", f"Cleanup failed: {str(error)}")
+            return
+        journal, results = result
+        errors = [outcome[1] for outcome in results if outcome is not None and outcome[1] is not None]
+        done = sum(1 for outcome in results if outcome is not None and outcome[1] is None)
+        self.show_action_errors(f"Successfully {verb} {done} files.", errors)
+        if not errors:
+            messagebox.showinfo("Cleanup", f"{done} files {verb} ({journal.action} run {journal.header['run']}).")
+
+    def finish_comparison(self):
+        finder, duplicates, error = self.comparison_result
+        self.running_finder = None
+        self.compare_button.config(state='normal')
+        self.cancel_button.config(state='disabled')
+        self.duplicates = duplicates
+        self.group_table = GroupTable(duplicates) if duplicates is not None else None
+        self.group_first = 0
+        self.refresh_matches()
+        self.result_algorithm = finder.algorithm
+        self.result_stats = finder.stats_text
+        self.scan_stats.set(f"Bytes read per stage - {finder.stats_text}")
+        if isinstance(error, ScanCancelled):
+            self.progress_bar.pack_forget()
+            self.processing_label.pack_forget()
+            self.total_matches.set("Comparison cancelled")
+            if self.manifest is not None or self.hash_cache is not None:
+                messagebox.showinfo("Cancelled", "Comparison cancelled. Files hashed so far are remembered, "
+                                                 "comparing the same folders again resumes from there.")
+            return
+        if error is not None:
+            messagebox.showerror("Error", f"Comparison failed: {str(error)}")
+
+        # Update UI; timed too, so a slow display shows up next to slow disks in the report
+        with self.telemetry.stage('display'):
+            self.show_comparison()
+
+    def save_scan_report(self):
+        # Stage timings, cache hits and the slowest files and folders of the last comparison
+        filepath = filedialog.asksaveasfilename(defaultextension='.json', filetypes=[("JSON", "*.json")],
+                                                initialfile='scan-report.json')
+        if not filepath:
+            return
+        try:
+            with open(filepath, 'w') as f:
+                json.dump(self.telemetry.report(), f, indent=2)
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to save the scan report: {str(e)}")
     
+    def save_results_file(self):
+        # The current results, including files already handled, can be opened again without a scan
+        if self.duplicates is None:
+            messagebox.showinfo("Save Results", "There are no results to save yet.")
+            return
+        filepath = filedialog.asksaveasfilename(defaultextension='.dedup', filetypes=[("Scan results", "*.dedup")],
+                                                initialfile='scan-results.dedup')
+        if not filepath:
+            return
+        try:
+            save_results(filepath, self.duplicates, self.result_stats)
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to save the results: {str(e)}")
+
+    def open_results_file(self):
+        if self.worker_busy():
+            return
+        filepath = filedialog.askopenfilename(filetypes=[("Scan results", "*.dedup"), ("All files", "*")],
+                                              title="Open scan results")
+        if not filepath:
+            return
+        try:
+            header = results_header(filepath)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Error", f"Cannot open {filepath}: {str(e)}")
+            return
+        # Results saved on another machine name folders that may be mounted elsewhere here
+        root_map = {}
+        for root in header['root_paths']:
+            if not os.path.isdir(root):
+                location = filedialog.askdirectory(title=f"Where is {root} on this computer?")
+                if location:
+                    root_map[root] = location
+        try:
+            duplicates, header = load_results(filepath, root_map)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Error", f"Cannot open {filepath}: {str(e)}")
+            return
+        self.show_loaded_results(duplicates, header)
+
+    def show_loaded_results(self, duplicates, header):
+        self.duplicates = duplicates
+        self.group_table = GroupTable(duplicates)
+        self.group_first = 0
+        self.matches = []
+        self.current_index = 0
+        self.group_position = 0
+        # The folders of the result become the ones compared next, so a rescan is one click away
+        roots = duplicates.root_paths
+        self.single_dir_mode.set(len(roots) == 1)
+        self.toggle_mode()
+        self.dir1.set(roots[0] if roots else "")
+        self.dir2.set(roots[1] if len(roots) > 1 else "")
+        self.similar_images.set(duplicates.algorithm in PERCEPTUAL_HASHES)
+        if duplicates.algorithm in PERCEPTUAL_HASHES:
+            self.perceptual_hash.set(duplicates.algorithm)
+        self.result_algorithm = duplicates.algorithm
+        self.result_stats = header['stats'] or ""
+        saved = datetime.fromtimestamp(header['created']).strftime('%Y-%m-%d %H:%M')
+        self.scan_stats.set(f"Saved scan of {saved} on {header['host']} - {self.result_stats}")
+        self.refresh_matches()
+        self.show_comparison()
+
     def show_comparison(self):
         # Clear progress bar and processing message
         self.progress_bar.pack_forget()
         self.processing_label.pack_forget()
         
-        if not self.matches:
+        if not self.duplicates:
             self.total_matches.set("No matching files found!")
             self.index_label.config(text="")
             messagebox.showinfo("Results", "No matching files found!")
             return
         
-        self.total_matches.set(f"Found {len(self.matches)} matching files")
+        self.total_matches.set(f"Found {self.describe_duplicates()}")
+        self.show_current_pair()
+
+    def refresh_matches(self):
+        # The viewer walks the groups in the order of the group list, and only builds the
+        # (group, left file, right file) pairs of a group once it gets there
+        self.refresh_groups()
+
+    def show_group(self, position, index=0):
+        # Makes the group at position in group_rows the one being viewed, at its pair index;
+        # a negative index counts from its last pair
+        rows = self.group_rows
+        if not rows:
+            self.group_position, self.matches, self.current_index = 0, [], 0
+            return
+        self.group_position = position = max(0, min(position, len(rows) - 1))
+        self.matches = self.group_pairs_at(position)
+        self.current_index = max(0, index + len(self.matches) if index < 0 else min(index, len(self.matches) - 1))
+
+    def group_pairs_at(self, position):
+        return self.duplicates.group_pairs(self.duplicates.get(self.group_table.group_id(self.group_rows[position])))
+
+    def refresh_group(self, group_id):
+        # After a file of the viewed group was handled: only that group's pairs are rebuilt, and
+        # its row leaves the list if the group is gone, the next one taking its place. The list
+        # keeps its order, with the group's new values, until it is sorted or filtered again, so
+        # a click costs nothing per other group.
+        position = self.group_position
+        if self.duplicates.groups.get(group_id) is None:
+            rows = self.group_rows
+            row = self.group_table.rows.get(group_id)
+            if position < len(rows) and rows[position] == row:
+                del rows[position]
+            elif row in rows:
+                rows.remove(row)
+            self.show_group(position)
+        else:
+            self.show_group(position, self.current_index)
+        self.show_group_rows(self.group_first)
+
+    def refresh_groups(self):
+        # Applies the sort and filters to the group table; the sort orders are cached in it, so
+        # only the filters cost a pass over the groups. The viewer stays on its group if that
+        # one is still listed, and starts over at the top of the list otherwise.
+        viewed = self.matches[0][0] if self.matches else None
+        if self.group_table is None:
+            self.group_rows = []
+        else:
+            key, descending = self.group_sort
+            try:
+                min_size = int(float(self.group_min_size.get() or 0) * 2**20)
+            except ValueError:
+                min_size = 0
+            try:
+                min_count = int(self.group_min_count.get() or 0)
+            except ValueError:
+                min_count = 0
+            self.group_rows = self.group_table.view(key, descending, self.group_extension.get().strip(),
+                                                    self.group_directory.get().strip(), min_size, min_count)
+        position = 0
+        if viewed is not None and viewed in self.duplicates.groups:
+            try:
+                position = self.group_rows.index(self.group_table.rows[viewed])
+            except ValueError:
+                viewed = None
+        self.show_group(position, self.current_index if viewed is not None else 0)
+        for key, title, _ in GROUP_COLUMNS:
+            if key == self.group_sort[0]:
+                title += " \u25bc" if self.group_sort[1] else " \u25b2"
+            self.group_tree.heading(key, text=title)
+        self.show_group_rows(self.group_first)
+
+    def fill_extension_filter(self):
+        # Finding the extensions takes a pass over the groups, so it waits until the list is opened
+        self.extension_filter.config(values=self.group_table.extensions() if self.group_table is not None else ())
+
+    def filter_groups(self):
+        self.group_first = 0
+        self.refresh_groups()
         self.show_current_pair()
 
+    def sort_groups(self, key):
+        # Clicking the sorted column again reverses it; numbers start largest first, text A to Z
+        current, descending = self.group_sort
+        if key == current:
+            self.group_sort = (key, not descending)
+        else:
+            self.group_sort = (key, key not in ('extension', 'directory'))
+        self.filter_groups()
+
+    def show_group_rows(self, first):
+        # Replaces the list items with the rows from first on; the only place items are created
+        total = len(self.group_rows)
+        self.group_first = first = max(0, min(first, total - GROUP_ROWS))
+        self.group_tree.delete(*self.group_tree.get_children())
+        for row in self.group_rows[first:first + GROUP_ROWS]:
+            reclaimable, count, size, name, folder = self.group_table.row_values(row)
+            self.group_tree.insert('', 'end', iid=str(row),
+                                   values=(format_size(reclaimable), count, format_size(size), name, folder))
+        if total:
+            self.group_scrollbar.set(first / total, min(first + GROUP_ROWS, total) / total)
+        else:
+            self.group_scrollbar.set(0, 1)
+
+    def scroll_groups(self, *args):
+        # Scrollbar command, ('moveto', fraction) or ('scroll', count, 'units' or 'pages')
+        if args[0] == 'moveto':
+            self.show_group_rows(int(float(args[1]) * len(self.group_rows)))
+        elif args[0] == 'scroll':
+            step = GROUP_ROWS if args[2] == 'pages' else 1
+            self.show_group_rows(self.group_first + int(args[1]) * step)
+
+    def on_group_wheel(self, event):
+        up = event.num == 4 or getattr(event, 'delta', 0) > 0
+        self.show_group_rows(self.group_first + (-3 if up else 3))
+        return 'break'
+
+    def on_group_selected(self, event=None):
+        selection = self.group_tree.selection()
+        if not selection:
+            return
+        # The items are the rows from group_first on, in list order
+        position = self.group_first + self.group_tree.index(selection[0])
+        if position != self.group_position:
+            self.show_group(position)
+            self.show_current_pair()
+
+    def describe_duplicates(self):
+        # The totals are kept by the group table, so this is not a pass over the groups
+        group_table = self.group_table
+        return (f"{group_table.redundant_total} duplicate files in {len(self.duplicates)} groups, "
+                f"{format_size(group_table.reclaimable_total)} reclaimable")
+
+    def get_match(self, index):
+        group_id, file1, file2 = self.matches[index]
+        table = self.duplicates.table
+        return {
+            'group': group_id,
+            'id1': file1,
+            'id2': file2,
+            'file1': table.path(file1),
+            'file2': table.path(file2),
+            'name1': table.name(file1),
+            'name2': table.name(file2)
+        }
+
     def show_current_pair(self):
         if not self.matches:
             self.index_label.config(text="")
             return
             
-        match = self.matches[self.current_index]
-        self.index_label.config(text=f"Viewing file {self.current_index + 1} of {len(self.matches)}")
+        match = self.get_match(self.current_index)
+        group = self.duplicates.get(match['group'])
+        self.index_label.config(text=f"Viewing file {self.current_index + 1} of {len(self.matches)} "
+                                     f"in group {self.group_position + 1} of {len(self.group_rows)} "
+                                     f"(group of {len(group)} copies)")
         
         try:
-            if match['is_image']:
+            if match['file1'].lower().endswith(self.supported_types['images']):
                 self.display_images(match)
             else:
                 self.display_file_info(match)
@@ -395,28 +886,15 @@ class FileComparisonUI:
             print(f"Error displaying files: {str(e)}")
 
     def display_images(self, match):
-        # Handle HEIC files
-        img1 = self.load_image(match['file1'])
-        img2 = self.load_image(match['file2'])
-        
         # Calculate size based on frame width
         frame_width = self.comparison_frame.winfo_width()
         target_size = (min(400, frame_width // 2 - 20), min(400, frame_width // 2 - 20))
         
-        # Set fixed size for images
-        img1.thumbnail(target_size)
-        img2.thumbnail(target_size)
-        
-        # Create white background
-        bg1 = Image.new('RGB', target_size, 'white')
-        bg2 = Image.new('RGB', target_size, 'white')
-        
-        # Paste images centered on white background
-        offset1 = ((target_size[0] - img1.size[0]) // 2, (target_size[1] - img1.size[1]) // 2)
-        offset2 = ((target_size[0] - img2.size[0]) // 2, (target_size[1] - img2.size[1]) // 2)
-        bg1.paste(img1, offset1)
-        bg2.paste(img2, offset2)
+        # Thumbnails come from the cache, usually already decoded by the prefetch worker
+        bg1 = self.thumbnails.get(match['file1'], target_size) or Image.new('RGB', target_size, 'lightgray')
+        bg2 = self.thumbnails.get(match['file2'], target_size) or Image.new('RGB', target_size, 'lightgray')
         
+        # PhotoImage has to be created on the Tk thread
         photo1 = ImageTk.PhotoImage(bg1)
         photo2 = ImageTk.PhotoImage(bg2)
         
@@ -430,6 +908,33 @@ class FileComparisonUI:
         # Keep references
         self.img_label1.image = photo1
         self.img_label2.image = photo2
+        self.prefetch_thumbnails(target_size)
+
+    def prefetch_thumbnails(self, target_size):
+        # Next pairs first, then the previous ones
+        table = self.duplicates.table
+        filepaths = []
+        for _, file1, file2 in self.nearby_pairs(1) + self.nearby_pairs(-1):
+            for filepath in (table.path(file1), table.path(file2)):
+                if filepath.lower().endswith(self.supported_types['images']) and filepath not in filepaths:
+                    filepaths.append(filepath)
+        self.thumbnails.prefetch(filepaths, target_size)
+
+    def nearby_pairs(self, step):
+        # The PREFETCH_PAIRS pairs after (step 1) or before (step -1) the current one, going on
+        # into the neighbouring groups of the list
+        pairs = []
+        position, index, group_pairs = self.group_position, self.current_index, self.matches
+        while len(pairs) < PREFETCH_PAIRS:
+            index += step
+            if not 0 <= index < len(group_pairs):
+                position += step
+                if not 0 <= position < len(self.group_rows):
+                    break
+                group_pairs = self.group_pairs_at(position)
+                index = 0 if step > 0 else len(group_pairs) - 1
+            pairs.append(group_pairs[index])
+        return pairs
     
     def get_display_path(self, filepath):
         if self.display_full_path.get():
@@ -459,30 +964,8 @@ class FileComparisonUI:
         self.img_label1.configure(image='', text=file1_info)
         self.img_label2.configure(image='', text=file2_info)
 
-    def load_image(self, filepath):
-        try:
-            if filepath.lower().endswith('.heic'):
-                import pillow_heif
-                heif_file = pillow_heif.read_heif(filepath)
-                return Image.frombytes(
-                    heif_file.mode,
-                    heif_file.size,
-                    heif_file.data,
-                    "raw",
-                )
-            return Image.open(filepath)
-        except (UnidentifiedImageError, ImportError, Exception) as e:
-            print(f"Error loading image {filepath}: {str(e)}")
-            # Return a blank image if loading fails
-            return Image.new('RGB', (400, 400), 'lightgray')
-
     def get_file_size(self, filepath):
-        size = os.path.getsize(filepath)
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size < 1024:
-                return f"{size:.2f} {unit}"
-            size /= 1024
-        return f"{size:.2f} TB"
+        return format_size(os.path.getsize(filepath))
 
     def get_file_type(self, filepath):
         return os.path.splitext(filepath)[1].upper()[1:]
@@ -491,7 +974,7 @@ class FileComparisonUI:
         if not self.matches or len(self.matches) <= self.current_index:
             return
         
-        match = self.matches[self.current_index]
+        match = self.get_match(self.current_index)
         file_path = match['file1'] if directory == "dir1" else match['file2']
         
         try:
@@ -507,84 +990,190 @@ class FileComparisonUI:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to open file: {str(e)}")
 
+    def describe_action(self, action):
+        if action == 'hardlink':
+            return "replace with a hard link to the other copy"
+        if action == 'reflink':
+            return "replace with a reflink (copy-on-write clone) of the other copy"
+        if action == 'quarantine':
+            return "move to the quarantine folder"
+        return "delete"
+
+    def check_action(self, action):
+        # Links share content, so they are only safe for files with identical content
+        if action in ('hardlink', 'reflink') and self.duplicates.algorithm in PERCEPTUAL_HASHES:
+            messagebox.showerror("Error", "Similar images differ in content, they can only be deleted or quarantined")
+            return False
+        return True
+
+    def quarantine_root(self, action, directory):
+        # Quarantined files stay on the filesystem of the folder they were found in
+        if action != 'quarantine':
+            return None
+        root = self.dir1.get() if directory == "dir1" or self.single_dir_mode.get() else self.dir2.get()
+        return os.path.join(root, QUARANTINE_DIR)
+
+    def quarantine_journal(self, quarantine_root):
+        # Files quarantined one at a time share one run per quarantine folder for the session, so
+        # they are undone together rather than leaving a journal per click
+        journal = self.click_journals.get(quarantine_root)
+        if journal is None:
+            journal = self.click_journals[quarantine_root] = create_journal('quarantine', [], quarantine_root)
+        return journal
+
     def delete_single_image(self, directory):
         if not self.matches or len(self.matches) <= self.current_index:
             return
+        if self.worker_busy():
+            return
+        action = self.dedup_action.get()
+        if not self.check_action(action):
+            return
             
-        match = self.matches[self.current_index]
+        match = self.get_match(self.current_index)
+        file_id = match['id1'] if directory == "dir1" else match['id2']
         file_path = match['file1'] if directory == "dir1" else match['file2']
-        dir_name = "Directory 1" if directory == "dir1" else "Directory 2"
+        keep_path = match['file2'] if directory == "dir1" else match['file1']
         
         if messagebox.askyesno("Confirm Deletion", 
-                             f"Are you sure you want to delete this file?\n\n"
+                             f"Are you sure you want to {self.describe_action(action)} this file?\n\n"
                              f"Location: {self.get_display_path(file_path)}\n"
                              f"Full path: {file_path}"):
+            # One file is quick enough for the Tk thread and done or not once this returns, so
+            # there is nothing to resume; only quarantined files are journaled, for Undo Quarantine
+            job = (file_path, keep_path, self.duplicates.table.stat_key(file_id))
             try:
-                os.remove(file_path)
-                # Remove success popup
-                self.matches.pop(self.current_index)
-                if self.matches:
-                    if self.current_index >= len(self.matches):
-                        self.current_index = len(self.matches) - 1
-                    self.show_current_pair()
+                if action == 'quarantine':
+                    journal = self.quarantine_journal(self.quarantine_root(action, directory))
+                    index, = journal.add_jobs([job])
+                    freed, error = apply_action(action, journal.jobs, 1, quarantine=journal.quarantine,
+                                                journal=journal, indices=[index])[index]
                 else:
-                    self.total_matches.set("No matching files remaining")
-                    self.img_label1.configure(image='')
-                    self.img_label2.configure(image='')
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to delete file: {str(e)}")
+                    freed, error = apply_action(action, [job], 1)[0]
+            except (OSError, ValueError) as e:
+                error = str(e)
+            if error is not None:
+                messagebox.showerror("Error", f"Failed to {action} file: {error}")
+                return
+            # Remove success popup
+            self.duplicates.remove_file(file_id)
+            self.group_table.update(match['group'])
+            self.refresh_group(match['group'])
+            if self.matches:
+                self.show_current_pair()
+            else:
+                self.total_matches.set("No matching files remaining")
+                self.img_label1.configure(image='')
+                self.img_label2.configure(image='')
 
     def delete_all_duplicates(self, directory):
-        if not self.matches:
+        if not self.duplicates:
+            return
+        if self.worker_busy():
+            return
+        action = self.dedup_action.get()
+        if not self.check_action(action):
             return
             
         dir_name = "Directory 1" if directory == "dir1" else "Directory 2"
         if messagebox.askyesno("Confirm Deletion", 
-                             f"Are you sure you want to delete ALL duplicate files from {dir_name}?\n"
+                             f"Are you sure you want to {self.describe_action(action)} ALL duplicate files "
+                             f"from {dir_name}?\n"
                              f"This will keep files in {('Directory 2' if directory == 'dir1' else 'Directory 1')} "
-                             f"and cannot be undone!"):
-            deleted = 0
-            errors = []
-            
-            for match in self.matches[:]:
-                file_path = match['file1'] if directory == "dir1" else match['file2']
-                try:
-                    os.remove(file_path)
-                    deleted += 1
-                    self.matches.remove(match)
-                except Exception as e:
-                    errors.append(f"Error deleting {file_path}: {str(e)}")
-            
-            if self.matches:
-                if self.current_index >= len(self.matches):
-                    self.current_index = len(self.matches) - 1
-                self.show_current_pair()
-            else:
-                self.total_matches.set("No matching files remaining")
-                self.img_label1.configure(image='', text='')
-                self.img_label2.configure(image='', text='')
-            
-            # Only show error message if there were errors
-            if errors:
-                message = f"Successfully deleted {deleted} files."
-                message += f"\n\nErrors occurred while deleting {len(errors)} files:"
-                for error in errors[:5]:
-                    message += f"\n- {error}"
-                if len(errors) > 5:
-                    message += "\n..."
-                messagebox.showerror("Deletion Errors", message)
-            
-            self.total_matches.set(f"Remaining matches: {len(self.matches)}")
+                             + ("and can be restored with Undo Quarantine." if action == 'quarantine'
+                                else "and cannot be undone!")):
+            # Every file shown on that side once, with the copy it was paired with as the one to link to.
+            # Groups drop out as they lose their last copy, so the whole run stays linear in the number of files.
+            side = 1 if directory == "dir1" else 2
+            table = self.duplicates.table
+            keep_ids = {}
+            group_of = {}
+            for pair in self.duplicates.pairs():
+                keep_ids.setdefault(pair[side], pair[3 - side])
+                group_of.setdefault(pair[side], pair[0])
+            file_ids = list(keep_ids)
+            jobs = [(table.path(i), table.path(keep_ids[i]), table.stat_key(i)) for i in file_ids]
+            # Further hard links of a file have to go too, or its data stays on disk
+            jobs.extend((table.path(name), table.path(keep_ids[i]), table.stat_key(name))
+                        for i in file_ids for name in self.duplicates.names(i)[1:]
+                        if table.sides[name] == table.sides[i])
+            workers = self.get_workers()
+            quarantine_root = self.quarantine_root(action, directory)
+
+            # The files are handled on the worker thread in per-folder batches, every outcome
+            # going to the journal; the results only change once it is done
+            def task(progress, cancel):
+                with create_journal(action, jobs, quarantine_root) as journal:
+                    results = apply_action(action, jobs, workers, progress, journal.quarantine, journal, cancel)
+                    return results, journal.path
+
+            self.start_cleanup(f"Handling duplicates ({action})", task,
+                               lambda result, error: self.finish_bulk_action(file_ids, group_of, result, error))
+
+    def finish_bulk_action(self, file_ids, group_of, result, error):
+        if error is not None:
+            messagebox.showerror("Error", f"Cleanup failed: {str(error)}")
+            return
+        results, journal_path = result
+        deleted = 0
+        skipped = 0
+        errors = []
+        for file_id, outcome in zip(file_ids, results):
+            if outcome is None:
+                skipped += 1
+                continue
+            freed, message = outcome
+            if message is not None:
+                errors.append(message)
+                continue
+            deleted += 1
+            self.duplicates.remove_file(file_id)
+            self.group_table.update(group_of[file_id])
+        errors.extend(outcome[1] for outcome in results[len(file_ids):] if outcome is not None and outcome[1] is not None)
+        self.refresh_matches()
+        
+        if self.matches:
+            self.show_current_pair()
+        else:
+            self.total_matches.set("No matching files remaining")
+            self.img_label1.configure(image='', text='')
+            self.img_label2.configure(image='', text='')
+        
+        self.show_action_errors(f"Successfully processed {deleted} files.", errors)
+        self.total_matches.set(f"Remaining: {self.describe_duplicates()}")
+        if skipped:
+            messagebox.showinfo("Cancelled", f"Cleanup cancelled with {skipped} files left, "
+                                             f"Resume Cleanup finishes it from its journal:\n{journal_path}")
+
+    def show_action_errors(self, message, errors):
+        # Only shows a message if there were errors
+        if not errors:
+            return
+        message += f"\n\nErrors occurred while processing {len(errors)} files:"
+        for error in errors[:5]:
+            message += f"\n- Error processing {error}"
+        if len(errors) > 5:
+            message += "\n..."
+        messagebox.showerror("Deletion Errors", message)
 
     def show_previous(self):
+        # Steps through the pairs of the viewed group, then on to the last pair of the group before
         if self.matches and self.current_index > 0:
             self.current_index -= 1
-            self.show_current_pair()
+        elif self.group_position > 0:
+            self.show_group(self.group_position - 1, -1)
+        else:
+            return
+        self.show_current_pair()
 
     def show_next(self):
         if self.matches and self.current_index < len(self.matches) - 1:
             self.current_index += 1
-            self.show_current_pair()
+        elif self.group_position < len(self.group_rows) - 1:
+            self.show_group(self.group_position + 1)
+        else:
+            return
+        self.show_current_pair()
 
 def main():
     root = tk.Tk()